@@ -1,19 +1,42 @@
+import threading
 from consultant_agent import ConsultantAgent
 from auditor_agent import AuditorAgent
 from tax_agent import TaxAgent
 
+# Agent classes by the name shown in the UI
+AGENT_CLASSES = {
+    "Dabby Consultant": ConsultantAgent,
+    "Auditor Agent": AuditorAgent,
+    "Tax Agent": TaxAgent,
+}
+
 class AgentFactory:
-    """Factory for creating agent instances"""
+    """Factory handing out shared agent instances"""
+    
+    _agents = {}
+    _lock = threading.Lock()
     
     @staticmethod
     def get_agent(agent_name):
-        """Get an agent instance by name"""
-        if agent_name == "Dabby Consultant":
-            return ConsultantAgent()
-        elif agent_name == "Auditor Agent":
-            return AuditorAgent()
-        elif agent_name == "Tax Agent":
-            return TaxAgent()
-        else:
-            # Default to consultant agent
-            return ConsultantAgent()
+        """Get the shared agent instance for a name.
+
+        Agents hold their conversation state per session id, so one instance
+        of each agent serves every session and thread. It is created on first
+        use and keeps its LLM client and session histories from then on.
+        """
+        # Default to consultant agent
+        agent_class = AGENT_CLASSES.get(agent_name, ConsultantAgent)
+        agent = AgentFactory._agents.get(agent_class)
+        if agent is None:
+            with AgentFactory._lock:
+                agent = AgentFactory._agents.get(agent_class)
+                if agent is None:
+                    agent = agent_class()
+                    AgentFactory._agents[agent_class] = agent
+        return agent
+    
+    @staticmethod
+    def active_agents():
+        """Agents created so far"""
+        with AgentFactory._lock:
+            return list(AgentFactory._agents.values())
@@ -0,0 +1,49 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from map_reduce import is_failed_analysis
+
+# Files extracted at the same time (large PDFs additionally use the PDF process pool)
+EXTRACTION_WORKERS = int(os.environ.get("DATALIS_EXTRACTION_WORKERS", 4))
+# File analyses sent to the LLM at the same time
+ANALYSIS_WORKERS = int(os.environ.get("DATALIS_ANALYSIS_WORKERS", 4))
+
+
+def analyze_files(agent, files, session_id, extraction_workers=EXTRACTION_WORKERS, analysis_workers=ANALYSIS_WORKERS,
+                  mode=None):
+    """Extract files in parallel and analyze them concurrently.
+
+    Each file is handed to the analysis pool as soon as its extraction
+    finishes. Yields (file, response, succeeded) in completion order, so
+    callers can show each result as soon as it is ready. mode is passed
+    to BaseAgent.analyze_file ("prefix" or "map_reduce").
+    """
+    if not files:
+        return
+
+    with ThreadPoolExecutor(max_workers=extraction_workers) as extractors, \
+            ThreadPoolExecutor(max_workers=analysis_workers) as analysts:
+        extractions = {extractors.submit(agent.extract_for_analysis, file["path"], mode): file for file in files}
+        analyses = {}
+        pending = set(extractions)
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in extractions:
+                    file = extractions.pop(future)
+                    try:
+                        content = future.result()
+                    except Exception as e:
+                        yield file, f"Error extracting {file['name']}: {str(e)}", False
+                        continue
+                    analysis = analysts.submit(agent.analyze_content, file["name"], content, session_id, mode)
+                    analyses[analysis] = file
+                    pending.add(analysis)
+                else:
+                    file = analyses.pop(future)
+                    try:
+                        response = future.result()
+                    except Exception as e:
+                        yield file, f"Error: {str(e)}", False
+                        continue
+                    yield file, response, not is_failed_analysis(response)
@@ -1,10 +1,67 @@
-from base_agent import BaseAgent
+from base_agent import BaseAgent, ANALYSIS_MODE
+from file_handler import FileHandler
+from keyword_index import KEYWORD_INDEX
+from cache import TieredCache, hash_text
+import tracing
 import os
 import tempfile
-from docx import Document
-from docx.shared import Pt, Inches
-from docx.enum.text import WD_ALIGN_PARAGRAPH
 import base64
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Report sections in document order: (key, heading, sections the prompt depends on)
+REPORT_SECTIONS = [
+    ("summary", "Executive Summary", ()),
+    ("scope", "Scope of Audit", ()),
+    ("findings", "Key Findings", ()),
+    ("recommendations", "Recommendations", ("findings",)),
+    ("conclusion", "Conclusion", ()),
+]
+
+# Inputs each section's prompt is built from (a section named here is its text);
+# a cached section is reused for as long as these are unchanged
+REPORT_SECTION_INPUTS = {
+    "summary": ("audit_type", "excerpts", "material_items"),
+    "scope": ("audit_type", "framework"),
+    "findings": ("audit_type", "excerpts", "material_items"),
+    "recommendations": ("audit_type", "findings"),
+    "conclusion": ("audit_type",),
+}
+# Bump when section prompts change so stale cached sections are not reused
+REPORT_SECTION_VERSION = 1
+
+# Generated report sections, so regenerating a report only re-requests the sections whose inputs changed
+REPORT_SECTION_CACHE = TieredCache(
+    max_entries=int(os.environ.get("DATALIS_REPORT_SECTION_CACHE_ENTRIES", 256)),
+    directory=os.environ.get("DATALIS_REPORT_SECTION_CACHE_DIR") or None
+)
+tracing.register_stats("report_section_cache", REPORT_SECTION_CACHE.stats)
+
+# Detected audit frameworks by (document set, audit type), so repeated reports skip the LLM round trip
+FRAMEWORK_CACHE = TieredCache(max_entries=int(os.environ.get("DATALIS_FRAMEWORK_CACHE_ENTRIES", 128)))
+tracing.register_stats("framework_cache", FRAMEWORK_CACHE.stats)
+# Detections in progress; concurrent requests for the same key wait for the same result
+_framework_requests = {}
+_framework_lock = threading.Lock()
+_prefetch_executor = None
+
+def _get_prefetch_executor():
+    """Return the thread pool running background framework detection, starting it on first use."""
+    global _prefetch_executor
+    with _framework_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="datalis-framework")
+        return _prefetch_executor
+
+# Keyword query for passages on common audit risk areas
+AUDIT_RISK_TERMS = (
+    "related party transaction provision contingent liability impairment write-off penalty default "
+    "overdue tds gst gstin reconciliation section 43b 40a suspense adjustment"
+)
+
+# Max report sections generated at the same time
+REPORT_SECTION_WORKERS = int(os.environ.get("DATALIS_REPORT_SECTION_WORKERS", 4))
 
 class AuditorAgent(BaseAgent):
     """Auditor Agent implementation"""
@@ -18,21 +75,77 @@ class AuditorAgent(BaseAgent):
         return """You are an expert auditor. Provide professional, accurate insights, with citations and references."""
     
     def determine_audit_framework(self, document_texts, audit_type=None):
-        """Identify the most appropriate audit framework based on document content."""
+        """Identify the most appropriate audit framework based on document content.
+
+        Results are memoized per document set and audit type, and a call made
+        while the same detection is running (e.g. a prefetch) waits for it.
+        """
         # Combine texts and get a representative sample
-        combined_text = "\n\n".join([f"Document: {text[:1500]}..." for text in document_texts])
-            
-        prompt = (
-            f"Based on these financial document excerpts:\n\n{combined_text}\n\n"
-            f"Determine the most appropriate audit framework for {audit_type or 'financial audit'}. "
-            f"Examples include SA 700, AS 1, Ind AS 109, etc. "
-            f"Provide the framework name and a brief explanation of why it's appropriate."
-        )
+        # Documents may be strings or lazy block iterators from FileHandler.iter_file_content
+        combined_text = "\n\n".join([f"Document: {FileHandler.take_text(text, 1500)}..." for text in document_texts])
+        cache_key = hash_text(self.system_prompt, audit_type or "", combined_text)
+        
+        with tracing.span("report.framework", audit_type=audit_type) as span:
+            with _framework_lock:
+                cached = FRAMEWORK_CACHE.get(cache_key)
+                request = _framework_requests.get(cache_key) if cached is None else None
+                owner = cached is None and request is None
+                if owner:
+                    request = _framework_requests[cache_key] = Future()
+            span.set(cache_hit=not owner)
+            if cached is not None:
+                return cached
+            if not owner:
+                return request.result()
             
-        return self.llm_service.get_response(prompt, self.system_prompt)
+            prompt = (
+                f"Based on these financial document excerpts:\n\n{combined_text}\n\n"
+                f"Determine the most appropriate audit framework for {audit_type or 'financial audit'}. "
+                f"Examples include SA 700, AS 1, Ind AS 109, etc. "
+                f"Provide the framework name and a brief explanation of why it's appropriate."
+            )
+            try:
+                framework = self.llm_service.get_response(prompt, self.system_prompt)
+                # Failed calls return an error message, which must not be reused
+                if not framework.startswith("Error"):
+                    FRAMEWORK_CACHE.set(cache_key, framework)
+                request.set_result(framework)
+                return framework
+            except Exception as e:
+                request.set_exception(e)
+                raise
+            finally:
+                with _framework_lock:
+                    _framework_requests.pop(cache_key, None)
+    
+    def prefetch_audit_framework(self, load_documents, audit_type=None):
+        """Run determine_audit_framework in the background so a later report finds it ready.
+
+        load_documents() returns the document texts and is called in the
+        background too; returns the Future of the detected framework.
+        """
+        def detect():
+            try:
+                return self.determine_audit_framework(load_documents(), audit_type)
+            except Exception as e:
+                print(f"Error prefetching audit framework: {str(e)}")
+                return None
+        return _get_prefetch_executor().submit(tracing.propagate(detect))
     
-    def generate_audit_report_docx(self, audit_type, document_texts, framework, company_info=None):
-        """Generate a professional DOCX audit report."""
+    def generate_audit_report_docx(self, audit_type, document_texts, framework, company_info=None, timings=None,
+                                   material_items=None, on_section=None):
+        """Generate a professional DOCX audit report.
+
+        If a timings dict is given it is filled with the generation time of
+        each section in seconds. material_items (FileHandler.extract_material_items)
+        replaces raw ledger rows in the summary and findings prompts.
+        on_section(key, text) is called as each section is finished.
+        """
+        # python-docx is only needed once a report is actually generated
+        from docx import Document
+        from docx.shared import Inches
+        from docx.enum.text import WD_ALIGN_PARAGRAPH
+
         doc = Document()
             
         # Add title
@@ -55,54 +168,13 @@ class AuditorAgent(BaseAgent):
             doc.add_heading('Company Information', 1)
             # ... (rest of company info implementation)
         
-        # Add executive summary
-        doc.add_heading('Executive Summary', 1)
-        summary_text = self.llm_service.get_response(
-            f"Create an executive summary for an {audit_type} report based on these documents:\n\n" +
-            "\n\n".join([text[:1500] + "..." for text in document_texts]) +
-            "\n\nWrite a professional, concise executive summary (3-4 paragraphs).",
-            self.system_prompt
-        )
-        doc.add_paragraph(summary_text)
-            
-        # Add scope section
-        doc.add_heading('Scope of Audit', 1)
-        scope_text = self.llm_service.get_response(
-            f"Create a scope section for an {audit_type} using framework {framework}. "
-            "Describe what was covered in the audit, methodology used, and time period.",
-            self.system_prompt
-        )
-        doc.add_paragraph(scope_text)
-            
-        # Add findings section
-        doc.add_heading('Key Findings', 1)
-        findings_text = self.llm_service.get_response(
-            f"Generate key findings for an {audit_type} based on these documents:\n\n" +
-            "\n\n".join([text[:1500] + "..." for text in document_texts]) +
-            "\n\nCreate 3-5 significant findings with details."
-            "\n\nProvide specific citations or references to the documents where applicable.",
-            self.system_prompt
-        )
-        doc.add_paragraph(findings_text)
-            
-        # Add recommendations
-        doc.add_heading('Recommendations', 1)
-        recommendations_text = self.llm_service.get_response(
-            f"Based on an {audit_type} audit with these findings:\n\n{findings_text}\n\n"
-            "Provide 3-5 specific, actionable recommendations.",
-            self.system_prompt
+        # Generate the sections (independent ones run concurrently), then add them in order
+        sections = self.generate_report_sections(
+            audit_type, document_texts, framework, timings, material_items, on_section
         )
-        doc.add_paragraph(recommendations_text)
-            
-        # Add conclusion
-        doc.add_heading('Conclusion', 1)
-        conclusion_text = self.llm_service.get_response(
-            f"Write a conclusion for an {audit_type} audit report that summarizes the overall assessment, "
-            f"significance of findings, and next steps. Keep it professional and concise."
-            f"Add final thoughts on the audit process and references to the documents reviewed.",
-            self.system_prompt
-        )
-        doc.add_paragraph(conclusion_text)
+        for key, heading, _ in REPORT_SECTIONS:
+            doc.add_heading(heading, 1)
+            doc.add_paragraph(sections[key])
             
         # Add digital signature if available
         if company_info and company_info.get("digital_signature"):
@@ -147,25 +219,180 @@ class AuditorAgent(BaseAgent):
             
         return temp_file_path
     
-    def analyze_documents(self, document_texts, audit_type=None):
-        """Analyze document content for audit insights."""
+    @staticmethod
+    def materiality_section(material_items):
+        """Prompt section presenting materiality-filtered ledger items ("" if there are none)"""
+        if not material_items:
+            return ""
+        return (
+            "Ledger line items filtered by the engagement's materiality thresholds "
+            "(only material items are listed; smaller items are given as aggregates):\n\n"
+            f"{material_items}\n\n"
+        )
+    
+    def _section_prompt(self, key, audit_type, excerpts, framework, results, material_items=None):
+        """Build the LLM prompt for a report section from its inputs."""
+        if key == "summary":
+            return (
+                f"Create an executive summary for an {audit_type} report based on these documents:\n\n" +
+                excerpts + "\n\n" + self.materiality_section(material_items) +
+                "Write a professional, concise executive summary (3-4 paragraphs)."
+            )
+        if key == "scope":
+            return (
+                f"Create a scope section for an {audit_type} using framework {framework}. "
+                "Describe what was covered in the audit, methodology used, and time period."
+            )
+        if key == "findings":
+            return (
+                f"Generate key findings for an {audit_type} based on these documents:\n\n" +
+                excerpts + "\n\n" + self.materiality_section(material_items) +
+                "Create 3-5 significant findings with details."
+                "\n\nProvide specific citations or references to the documents where applicable."
+            )
+        if key == "recommendations":
+            return (
+                f"Based on an {audit_type} audit with these findings:\n\n{results['findings']}\n\n"
+                "Provide 3-5 specific, actionable recommendations."
+            )
+        if key == "conclusion":
+            return (
+                f"Write a conclusion for an {audit_type} audit report that summarizes the overall assessment, "
+                f"significance of findings, and next steps. Keep it professional and concise."
+                f"Add final thoughts on the audit process and references to the documents reviewed."
+            )
+        raise ValueError(f"Unknown report section: {key}")
+    
+    def section_cache_key(self, key, inputs, results):
+        """Build the cache key of a report section from the inputs its prompt uses."""
+        values = [results[name] if name in results else inputs[name] for name in REPORT_SECTION_INPUTS[key]]
+        return f"{key}:v{REPORT_SECTION_VERSION}:" + hash_text(self.system_prompt, *values)
+    
+    def _generate_section(self, key, audit_type, excerpts, framework, results, material_items=None):
+        """Generate one report section and return (text, seconds taken)."""
+        started = time.perf_counter()
+        with tracing.span("report.section", section=key):
+            text = self.llm_service.get_response(
+                self._section_prompt(key, audit_type, excerpts, framework, results, material_items),
+                self.system_prompt
+            )
+        return text, time.perf_counter() - started
+    
+    def generate_report_sections(self, audit_type, document_texts, framework, timings=None, material_items=None,
+                                 on_section=None):
+        """Generate every report section, running sections concurrently as soon
+        as the sections they depend on are finished.
+
+        material_items is the text from FileHandler.extract_material_items;
+        it is given to the summary and findings prompts in full. on_section,
+        if given, is called with (key, text) as each section is finished.
+        Sections whose inputs are unchanged since an earlier report are taken
+        from REPORT_SECTION_CACHE and timed as 0 seconds.
+        """
+        # Documents may be strings or lazy block iterators, so read each excerpt once
+        excerpts = "\n\n".join([FileHandler.take_text(text, 1500) + "..." for text in document_texts])
+        dependencies = {key: depends_on for key, _, depends_on in REPORT_SECTIONS}
+        inputs = {
+            "audit_type": audit_type, "excerpts": excerpts, "framework": framework,
+            "material_items": material_items or ""
+        }
+        
+        results = {}
+        running = {}
+        section_timings = {}
+        started = time.perf_counter()
+        with tracing.span("report.sections", audit_type=audit_type) as span:
+            with ThreadPoolExecutor(max_workers=REPORT_SECTION_WORKERS) as executor:
+                while len(results) < len(dependencies):
+                    # Start every section whose inputs are ready, unless it is cached
+                    for key, depends_on in dependencies.items():
+                        if key in results or key in [running_key for running_key, _ in running.values()]:
+                            continue
+                        if not all(dep in results for dep in depends_on):
+                            continue
+                        cache_key = self.section_cache_key(key, inputs, results)
+                        cached = REPORT_SECTION_CACHE.get(cache_key)
+                        if cached is not None:
+                            results[key], section_timings[key] = cached, 0.0
+                            if on_section is not None:
+                                on_section(key, cached)
+                            continue
+                        future = executor.submit(
+                            tracing.propagate(self._generate_section), key, audit_type, excerpts, framework,
+                            dict(results), material_items
+                        )
+                        running[future] = (key, cache_key)
+                    
+                    if not running:
+                        # Only cached sections were ready; their dependents are checked on the next pass
+                        continue
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        key, cache_key = running.pop(future)
+                        results[key], section_timings[key] = future.result()
+                        # Failed calls return an error message, which must not be reused
+                        if not results[key].startswith("Error"):
+                            REPORT_SECTION_CACHE.set(cache_key, results[key])
+                        if on_section is not None:
+                            on_section(key, results[key])
+            span.set(cached_sections=sum(1 for seconds in section_timings.values() if seconds == 0.0))
+        
+        # Per-section durations are also recorded as report.section spans
+        section_timings["total"] = time.perf_counter() - started
+        if timings is not None:
+            timings.update(section_timings)
+        
+        return results
+    
+    def analyze_documents(self, document_texts, audit_type=None, material_items=None, mode=None):
+        """Analyze document content for audit insights.
+
+        With mode "map_reduce" every document is read in full, chunk by
+        chunk, instead of only its first 3,000 characters. Defaults to
+        DATALIS_ANALYSIS_MODE.
+        """
+        instruction = (
+            self.materiality_section(material_items) +
+            "Provide key observations, potential risks, and compliance issues."
+        )
+        
+        if (mode or ANALYSIS_MODE) == "map_reduce":
+            result = self.map_reduce_analysis(
+                self.iter_documents(document_texts),
+                f"Note the facts, figures, risks and compliance issues relevant to a "
+                f"{audit_type or 'Financial Statement Audit'} in this part of the financial documents.",
+                f"Analyze these financial documents for a {audit_type or 'Financial Statement Audit'} "
+                f"from the material below.\n\n" + instruction
+            )
+            return result.render()
+        
         # Combine texts and get a representative sample
-        combined_text = "\n\n".join([text[:3000] for text in document_texts])
+        combined_text = "\n\n".join([FileHandler.take_text(text, 3000) for text in document_texts])
         
         prompt = (
             f"Analyze these financial documents for a {audit_type or 'Financial Statement Audit'}:\n\n{combined_text}\n\n"
-            "Provide key observations, potential risks, and compliance issues."
+            + instruction
         )
                 
         return self.llm_service.get_response(prompt, self.system_prompt)
     
-    def generate_suggested_questions(self, text):
-        """Generate relevant audit questions based on document content."""
+    def generate_suggested_questions(self, text, session_id=None):
+        """Generate relevant audit questions based on document content.
+
+        With a session_id, passages of the session's uploads that mention
+        common audit risk areas are found by keyword search and added.
+        """
         # Limit text length for API
         sample_text = text[:4000]
+        
+        passages = ""
+        if session_id is not None:
+            passages = self.format_excerpts(KEYWORD_INDEX.search(session_id, AUDIT_RISK_TERMS))
+            if passages:
+                passages += "\n\n"
             
         prompt = (
-            f"Based on the following financial information:\n\n{sample_text}\n\n"
+            f"Based on the following financial information:\n\n{sample_text}\n\n" + passages +
             "Generate 5 key questions an auditor should ask. "
             "Format each question as a numbered list (1., 2., etc.). "
             "Focus on potential risk areas, compliance concerns, and areas needing clarification."
@@ -1,6 +1,17 @@
+import os
+import asyncio
 from abc import ABC, abstractmethod
+import tracing
 from file_handler import FileHandler
-from llm_service import LLMService
+from llm_service import LLMService, RequestSlots
+from history_manager import HistoryManager
+from session_store import SessionStore, history_size
+from map_reduce import map_reduce
+from vector_index import VECTOR_INDEX, RETRIEVAL_TOP_K
+from keyword_index import KEYWORD_INDEX, fuse_results
+
+# How files are analyzed: "prefix" sends the start of the file, "map_reduce" all of it in chunks
+ANALYSIS_MODE = os.environ.get("DATALIS_ANALYSIS_MODE", "prefix")
 
 class BaseAgent(ABC):
     """Base class for all agent implementations"""
@@ -8,7 +19,12 @@ class BaseAgent(ABC):
     def __init__(self):
         self.llm_service = LLMService()
         self.file_handler = FileHandler()
-        self.conversation_history = {}
+        self.history_manager = HistoryManager()
+        # Histories of idle sessions are evicted along with their token stats and turn lock
+        self.conversation_history = SessionStore(on_evict=self._end_session, size_of=history_size)
+        # One chat turn at a time per session; agents are shared by every session. Never
+        # evicted on its own, since a lock dropped while held would let a second turn in
+        self._session_locks = SessionStore(ttl=None, max_sessions=None)
     
     @property
     @abstractmethod
@@ -22,62 +38,235 @@ class BaseAgent(ABC):
         """Return the name of this agent"""
         pass
     
-    def analyze_file(self, file_name, file_path, session_id):
-        """Analyze a file and return insights"""
-        file_content = self.file_handler.process_file(file_path)
+    def analyze_file(self, file_name, file_path, session_id, mode=None):
+        """Analyze a file and return insights.
+
+        mode "prefix" analyzes the first 5,000 characters; "map_reduce"
+        analyzes the whole file in token-sized chunks. Defaults to
+        DATALIS_ANALYSIS_MODE.
+        """
+        with tracing.span("agent.analyze_file", agent=self.name, mode=mode or ANALYSIS_MODE):
+            file_content = self.extract_for_analysis(file_path, mode)
+            return self.analyze_content(file_name, file_content, session_id, mode)
+    
+    def extract_for_analysis(self, file_path, mode=None):
+        """Extract the part of a file that is sent to the LLM for analysis"""
+        if (mode or ANALYSIS_MODE) == "map_reduce":
+            # The whole document is analyzed, so extract (and cache) all of it
+            return self.file_handler.process_file(file_path)
+        # Only the part of the document that is sent to the LLM gets parsed
+        return self.file_handler.read_file_prefix(file_path, 5000)
+    
+    def analyze_content(self, file_name, file_content, session_id, mode=None):
+        """Analyze already extracted file content and return insights"""
+        if (mode or ANALYSIS_MODE) == "map_reduce":
+            return self._analyze_content_map_reduce(file_name, file_content, session_id)
         
         if "Error" in file_content or "not found" in file_content:
             return file_content
         
-        if session_id not in self.conversation_history:
-            self.conversation_history[session_id] = []
-        
         # Add file content to conversation
         file_message = f"Please analyze this file: {file_content[:5000]}..."
-        self.conversation_history[session_id].append({
-            "role": "user",
-            "content": file_message
-        })
         
         # Get response from LLM
-        messages = [{"role": "system", "content": self.system_prompt}] + self.conversation_history[session_id]
+        messages = self._build_messages(session_id, file_message)
         response = self.llm_service.get_chat_response(messages)
         
-        # Add response to conversation history
-        self.conversation_history[session_id].append({
-            "role": "assistant",
-            "content": response
-        })
+        # Add the exchange to conversation history
+        self._record_turn(session_id, file_message, response)
         
         return response
     
-    def chat(self, message, session_id):
-        """Process a chat message and return a response"""
-        if not message.strip():
-            return "Please provide a message."
-            
-        if session_id not in self.conversation_history:
-            self.conversation_history[session_id] = []
+    def _analyze_content_map_reduce(self, file_name, file_content, session_id):
+        """Analyze the whole of a file's content chunk by chunk"""
+        if FileHandler.is_extraction_error(file_content):
+            return file_content
         
-        # Add user message to conversation history
-        self.conversation_history[session_id].append({
-            "role": "user",
-            "content": message
-        })
+        result = self.map_reduce_analysis(
+            file_content,
+            f"You are reading one part of the file {file_name}. "
+            "List the key facts, figures, risks and issues in this part.",
+            f"Provide a complete analysis of the file {file_name} from the material below."
+        )
+        if result.text.startswith("Error"):
+            return result.text
+        response = result.render()
         
-        # Get response from LLM
-        messages = [{"role": "system", "content": self.system_prompt}] + self.conversation_history[session_id]
-        response = self.llm_service.get_chat_response(messages)
-        
-        # Add response to conversation history
-        self.conversation_history[session_id].append({
-            "role": "assistant",
-            "content": response
-        })
+        # The analysis stands in for the file content in the conversation history
+        file_message = f"Please analyze this file: {file_name}"
+        self._record_turn(session_id, file_message, response)
         
         return response
     
+    def map_reduce_analysis(self, document, map_instruction, reduce_instruction, **options):
+        """Analyze a document of any length by map-reduce (see map_reduce.map_reduce)"""
+        return map_reduce(self.llm_service, self.system_prompt, document, map_instruction, reduce_instruction, **options)
+    
+    @staticmethod
+    def iter_documents(document_texts):
+        """Chain documents (strings or block iterators) into one block stream with a header per document"""
+        for index, document in enumerate(document_texts, start=1):
+            yield f"\n\nDocument {index}:\n"
+            if isinstance(document, str):
+                yield from document.splitlines(keepends=True)
+            else:
+                yield from document
+    
+    def format_user_message(self, message):
+        """Return the user message as it should be sent to the LLM"""
+        return message
+    
+    @staticmethod
+    def search_documents(session_id, query, k=RETRIEVAL_TOP_K):
+        """Hybrid search of a session's uploads: BM25 keyword matches (exact
+        account names, GSTINs, section and invoice numbers) fused with
+        vector similarity by reciprocal rank"""
+        return fuse_results([
+            KEYWORD_INDEX.search(session_id, query, k * 2),
+            VECTOR_INDEX.search(session_id, query, k * 2)
+        ], k)
+    
+    @staticmethod
+    def format_excerpts(results):
+        """Format search results as a prompt section ("" if there are none)"""
+        if not results:
+            return ""
+        excerpts = "\n\n".join(
+            f"[{result['file']}, part {result['chunk'] + 1}]\n{result['text']}" for result in results
+        )
+        return f"Relevant excerpts from the uploaded documents:\n\n{excerpts}"
+    
+    def retrieve_context(self, session_id, query):
+        """Excerpts of the session's uploaded documents most relevant to a question ("" if none)"""
+        with tracing.span("agent.retrieve") as span:
+            results = self.search_documents(session_id, query)
+            span.set(results=len(results))
+            return self.format_excerpts(results)
+    
+    def _end_session(self, session_id, history):
+        self.history_manager.clear(session_id)
+        lock = self._session_locks.get(session_id)
+        if lock is not None and not lock.in_use():
+            self._session_locks.pop(session_id)
+    
+    def session_lock(self, session_id):
+        """Lock serializing a session's chat turns, usable with `with` and `async with`"""
+        return self._session_locks.setdefault(session_id, RequestSlots(1))
+    
+    def _history(self, session_id):
+        """The session's history list, created atomically on first use"""
+        return self.conversation_history.setdefault(session_id, [])
+    
+    def _build_messages(self, session_id, user_message, context=""):
+        """Build the request messages: system prompt, history, then the new user message"""
+        # Work on a snapshot so concurrent analyses of the same session can append meanwhile
+        history = list(self._history(session_id))
+        
+        # Retrieved context goes with this request only and is not kept in history
+        if context:
+            user_message = f"{user_message}\n\n{context}"
+        
+        # Older turns are summarized or dropped to keep the prompt within the token budget
+        with tracing.span("agent.build_prompt", history_messages=len(history)):
+            return self.history_manager.build_messages(
+                session_id,
+                self.system_prompt,
+                history,
+                user_message
+            )
+    
+    def _record_turn(self, session_id, user_message, response):
+        """Add a user message and the assistant's response to conversation history"""
+        # A single extend keeps the pair together when other threads record turns too
+        self._history(session_id).extend([
+            {"role": "user", "content": user_message},
+            {"role": "assistant", "content": response}
+        ])
+    
+    def chat(self, message, session_id):
+        """Process a chat message and return a response"""
+        with tracing.span("agent.chat", agent=self.name):
+            if not message.strip():
+                return "Please provide a message."
+            
+            user_message = self.format_user_message(message)
+            
+            context = self.retrieve_context(session_id, message)
+            
+            # Turns of one session run in order so each sees the previous exchange
+            with self.session_lock(session_id):
+                # Get response from LLM, with the document excerpts relevant to the question
+                messages = self._build_messages(session_id, user_message, context)
+                response = self.llm_service.get_chat_response(messages)
+                
+                # Add the exchange to conversation history
+                self._record_turn(session_id, user_message, response)
+            
+            return response
+    
+    async def achat(self, message, session_id):
+        """Async variant of chat for use from async request handlers"""
+        with tracing.span("agent.chat", agent=self.name):
+            if not message.strip():
+                return "Please provide a message."
+            
+            user_message = self.format_user_message(message)
+            
+            # Retrieval may wait for documents still being indexed, so keep it off the event loop
+            context = await asyncio.to_thread(self.retrieve_context, session_id, message)
+            async with self.session_lock(session_id):
+                messages = self._build_messages(session_id, user_message, context)
+                response = await self.llm_service.aget_chat_response(messages)
+                
+                self._record_turn(session_id, user_message, response)
+            
+            return response
+    
+    def stream_chat(self, message, session_id):
+        """Process a chat message, yielding the response as it is generated"""
+        with tracing.span("agent.stream_chat", agent=self.name):
+            if not message.strip():
+                yield "Please provide a message."
+                return
+            
+            user_message = self.format_user_message(message)
+            
+            context = self.retrieve_context(session_id, message)
+            with self.session_lock(session_id):
+                messages = self._build_messages(session_id, user_message, context)
+                parts = []
+                for delta in self.llm_service.stream_chat_response(messages):
+                    parts.append(delta)
+                    yield delta
+                
+                # Only a fully received response is added to conversation history
+                self._record_turn(session_id, user_message, "".join(parts))
+    
+    async def astream_chat(self, message, session_id):
+        """Async variant of stream_chat"""
+        with tracing.span("agent.stream_chat", agent=self.name):
+            if not message.strip():
+                yield "Please provide a message."
+                return
+            
+            user_message = self.format_user_message(message)
+            
+            context = await asyncio.to_thread(self.retrieve_context, session_id, message)
+            async with self.session_lock(session_id):
+                messages = self._build_messages(session_id, user_message, context)
+                parts = []
+                async for delta in self.llm_service.astream_chat_response(messages):
+                    parts.append(delta)
+                    yield delta
+                
+                self._record_turn(session_id, user_message, "".join(parts))
+    
     def clear_history(self, session_id):
         """Clear conversation history for a session"""
         if session_id in self.conversation_history:
             self.conversation_history[session_id] = []
+        self.history_manager.clear(session_id)
+    
+    def history_stats(self, session_id):
+        """Return prompt token totals and savings for a session"""
+        return self.history_manager.stats(session_id)
@@ -0,0 +1,374 @@
+"""
+Datalis end-to-end latency benchmark
+
+Runs agent chat, file analysis, audit report generation and file extraction
+against a synthetic document corpus with the offline LLM stand-in, and
+reports p50/p95/p99 latency, throughput and peak RSS.
+
+    python benchmark.py --iterations 20 --concurrency 4 --json bench.json
+
+With --load-test it instead runs many concurrent chat sessions against the
+shared agents and checks that every session's history is intact.
+
+    python benchmark.py --load-test --sessions 100 --messages 5
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Never call the real API from a benchmark
+os.environ["DATALIS_LLM_BACKEND"] = "fake"
+
+SCENARIOS = ["process_file", "analyze_file", "chat", "audit_report"]
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages, lines_per_page=40):
+    """Write a simple text PDF without any PDF library."""
+    objects = []
+    page_ids = []
+    font_id = 3
+    next_id = 4
+    for page_num in range(pages):
+        lines = [
+            f"Page {page_num + 1} line {line}: Revenue from operations {1000 + page_num * 37 + line} "
+            f"GSTIN 27AAACB{page_num:04d}Q1Z{line % 10} section 194J"
+            for line in range(lines_per_page)
+        ]
+        content = "BT /F1 9 Tf 40 800 Td 11 TL " + " ".join(f"({_pdf_escape(line)}) '" for line in lines) + " ET"
+        content_id, page_id = next_id, next_id + 1
+        next_id += 2
+        objects.append((content_id, f"<< /Length {len(content)} >>\nstream\n{content}\nendstream"))
+        objects.append((page_id, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                                 f"/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {content_id} 0 R >>"))
+        page_ids.append(page_id)
+    objects.append((1, "<< /Type /Catalog /Pages 2 0 R >>"))
+    objects.append((2, f"<< /Type /Pages /Kids [{' '.join(f'{pid} 0 R' for pid in page_ids)}] /Count {pages} >>"))
+    objects.append((font_id, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"))
+    objects.sort()
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for object_id, body in objects:
+        offsets[object_id] = len(output)
+        output += f"{object_id} 0 obj\n{body}\nendobj\n".encode('latin-1')
+    xref_offset = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode('latin-1')
+    for object_id in range(1, len(objects) + 1):
+        output += f"{offsets[object_id]:010d} 00000 n \n".encode('latin-1')
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode('latin-1')
+    with open(path, 'wb') as file:
+        file.write(output)
+
+
+def ledger_frame(rows):
+    """Synthetic general ledger as a DataFrame."""
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(7)
+    return pd.DataFrame({
+        "Date": pd.date_range("2024-04-01", periods=rows, freq="h").strftime("%Y-%m-%d"),
+        "Account": rng.choice(["Sales", "Purchases", "Salaries", "Rent", "GST Payable", "Bank"], rows),
+        "Voucher": [f"INV-{i:07d}" for i in range(rows)],
+        "Debit": np.round(rng.lognormal(8, 1.5, rows), 2),
+        "Credit": np.round(rng.lognormal(8, 1.5, rows), 2),
+    })
+
+
+def build_corpus(directory, pdf_pages=(5, 120), ledger_rows=(500, 50000)):
+    """Create the synthetic PDF/XLSX/DOCX/CSV/TXT corpus and return the file paths."""
+    import docx
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+
+    for pages in pdf_pages:
+        path = os.path.join(directory, f"annual_report_{pages}p.pdf")
+        write_pdf(path, pages)
+        paths.append(path)
+
+    for rows in ledger_rows:
+        frame = ledger_frame(rows)
+        csv_path = os.path.join(directory, f"ledger_{rows}.csv")
+        frame.to_csv(csv_path, index=False)
+        paths.append(csv_path)
+        xlsx_path = os.path.join(directory, f"trial_balance_{rows}.xlsx")
+        frame.head(min(rows, 20000)).to_excel(xlsx_path, index=False)
+        paths.append(xlsx_path)
+
+    document = docx.Document()
+    for index in range(300):
+        document.add_paragraph(
+            f"Note {index}: The company recognised deferred tax assets of Rs {index * 1234} lakh "
+            f"under Ind AS 12 and provisions under Ind AS 37."
+        )
+    docx_path = os.path.join(directory, "notes_to_accounts.docx")
+    document.save(docx_path)
+    paths.append(docx_path)
+
+    txt_path = os.path.join(directory, "board_minutes.txt")
+    with open(txt_path, 'w', encoding='utf-8') as file:
+        for index in range(2000):
+            file.write(f"Resolution {index}: approved related party transaction RPT-{index:05d}.\n")
+    paths.append(txt_path)
+
+    return paths
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of already sorted values."""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (0 where unavailable)."""
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_scenario(name, operation, inputs, iterations, concurrency):
+    """Run operation over inputs for the given iterations and collect latency stats."""
+    tasks = [inputs[i % len(inputs)] for i in range(iterations)]
+    latencies = []
+    errors = 0
+
+    def timed(task):
+        started = time.perf_counter()
+        try:
+            operation(task)
+            failed = False
+        except Exception as e:
+            print(f"[{name}] error: {str(e)}")
+            failed = True
+        return time.perf_counter() - started, failed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for seconds, failed in executor.map(timed, tasks):
+            latencies.append(seconds)
+            errors += failed
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "scenario": name,
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "errors": errors,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "throughput_per_s": iterations / elapsed if elapsed else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_benchmarks(args):
+    """Build the corpus, run the selected scenarios and return their results."""
+    import llm_service
+    from fake_llm import FakeLLMBackend
+    from file_handler import FileHandler, EXTRACTION_CACHE
+    from consultant_agent import ConsultantAgent
+    from auditor_agent import AuditorAgent, REPORT_SECTION_CACHE
+
+    llm_service.use_fake_backend(FakeLLMBackend(
+        latency=args.latency_ms / 1000,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=1
+    ))
+
+    corpus_dir = args.corpus_dir or tempfile.mkdtemp(prefix="datalis_bench_")
+    print(f"Building synthetic corpus in {corpus_dir}...")
+    paths = build_corpus(corpus_dir)
+
+    def cold_caches():
+        # Measure real work unless warm caches were requested
+        if not args.warm_cache:
+            EXTRACTION_CACHE.clear()
+            llm_service.RESPONSE_CACHE.clear()
+            REPORT_SECTION_CACHE.clear()
+
+    consultant = ConsultantAgent()
+    auditor = AuditorAgent()
+
+    def process_file(path):
+        cold_caches()
+        FileHandler.process_file(path)
+
+    def analyze_file(path):
+        cold_caches()
+        session_id = f"bench-analyze-{time.perf_counter_ns()}"
+        consultant.analyze_file(os.path.basename(path), path, session_id)
+        consultant.clear_history(session_id)
+
+    def chat(question):
+        session_id = f"bench-chat-{time.perf_counter_ns()}"
+        consultant.chat(question, session_id)
+        consultant.chat("Explain the biggest risk in more detail.", session_id)
+        consultant.clear_history(session_id)
+
+    excerpts = [FileHandler.read_file_prefix(path, 3000) for path in paths]
+
+    def audit_report(audit_type):
+        cold_caches()
+        report_path = auditor.generate_audit_report_docx(audit_type, excerpts, "SA 700")
+        os.remove(report_path)
+
+    operations = {
+        "process_file": (process_file, paths),
+        "analyze_file": (analyze_file, paths),
+        "chat": (chat, ["What are the GST compliance risks?", "Summarize the ledger."]),
+        "audit_report": (audit_report, ["Companies (Auditor's Report) Order", "Indian Accounting Standards"]),
+    }
+
+    results = []
+    for name in args.scenarios:
+        operation, inputs = operations[name]
+        iterations = max(1, args.iterations // 4) if name == "audit_report" else args.iterations
+        print(f"Running {name} ({iterations} iterations, concurrency {args.concurrency})...")
+        results.append(run_scenario(name, operation, inputs, iterations, args.concurrency))
+    return results
+
+
+def check_history(agent, session_id, questions):
+    """Return a list of problems with a session's history after the load test."""
+    history = agent.conversation_history.get(session_id, [])
+    problems = []
+    if len(history) != 2 * len(questions):
+        problems.append(f"{session_id}: {len(history)} messages, expected {2 * len(questions)}")
+    roles = [message["role"] for message in history]
+    if roles != ["user", "assistant"] * (len(history) // 2):
+        problems.append(f"{session_id}: messages out of user/assistant order")
+    # Every question must be recorded exactly once, and nothing from other sessions
+    asked = [message["content"] for message in history if message["role"] == "user"]
+    for question in questions:
+        if sum(content.startswith(question) for content in asked) != 1:
+            problems.append(f"{session_id}: question not recorded exactly once: {question}")
+    foreign = [content for content in asked if not content.startswith(f"[{session_id}]")]
+    if foreign:
+        problems.append(f"{session_id}: {len(foreign)} message(s) from other sessions")
+    return problems
+
+
+def run_load_test(args):
+    """Chat from many sessions at once through the shared agents and verify every history.
+
+    Each session's questions are also sent two at a time, so turns of the
+    same session race each other as well as other sessions.
+    """
+    import llm_service
+    from fake_llm import FakeLLMBackend
+    from agent_factory import AgentFactory
+
+    llm_service.use_fake_backend(FakeLLMBackend(
+        latency=args.latency_ms / 1000,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=1
+    ))
+    agent = AgentFactory.get_agent("Dabby Consultant")
+
+    questions = {
+        f"load-{index}": [f"[load-{index}] Question {number}: what is the GST exposure?" for number in range(args.messages)]
+        for index in range(args.sessions)
+    }
+    # Question-major order so every session has turns in flight at the same time
+    tasks = [
+        (session_id, session_questions[number])
+        for number in range(args.messages)
+        for session_id, session_questions in questions.items()
+    ]
+
+    def chat(task):
+        session_id, question = task
+        response = agent.chat(question, session_id)
+        if response.startswith("Error"):
+            raise RuntimeError(response)
+
+    print(f"Running load test ({args.sessions} sessions x {args.messages} messages)...")
+    result = run_scenario("load_test", chat, tasks, len(tasks), args.sessions * 2)
+
+    problems = []
+    for session_id, session_questions in questions.items():
+        problems.extend(check_history(agent, session_id, session_questions))
+        agent.clear_history(session_id)
+    result["history_errors"] = len(problems)
+    result["rate_limits"] = llm_service.LLMService.rate_limit_stats()
+    for problem in problems[:20]:
+        print(f"History error: {problem}")
+    return result
+
+
+def print_results(results):
+    """Print results as an aligned table."""
+    header = f"{'scenario':<14}{'iters':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>9}{'RSS MB':>9}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result['scenario']:<14}{result['iterations']:>7}{result['errors']:>8}"
+            f"{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}{result['p99_ms']:>10.1f}"
+            f"{result['throughput_per_s']:>9.2f}{result['peak_rss_mb']:>9.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Datalis end-to-end latency benchmark (offline LLM)")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=200, help="Fake LLM time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=250, help="Fake LLM generation rate")
+    parser.add_argument("--completion-tokens", type=int, default=200, help="Fake LLM response length")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of fake LLM calls that fail")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Fraction of fake LLM calls rejected with a 429 (retried with backoff)")
+    parser.add_argument("--warm-cache", action="store_true", help="Keep extraction/response caches between runs")
+    parser.add_argument("--corpus-dir", help="Where to write the synthetic corpus (default: temp dir)")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    parser.add_argument("--load-test", action="store_true", help="Run the concurrent session load test instead")
+    parser.add_argument("--sessions", type=int, default=100, help="Concurrent sessions in the load test")
+    parser.add_argument("--messages", type=int, default=5, help="Messages per session in the load test")
+    args = parser.parse_args()
+
+    if args.load_test:
+        results = [run_load_test(args)]
+    else:
+        results = run_benchmarks(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+    if args.load_test:
+        history_errors = results[0]["history_errors"]
+        print("History check: " + ("OK" if not history_errors else f"{history_errors} error(s)"))
+        print(f"Rate limiting: {results[0]['rate_limits']}")
+        sys.exit(1 if history_errors or results[0]["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
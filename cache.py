@@ -0,0 +1,213 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_text(*parts):
+    """Return the SHA-256 hex digest of one or more strings."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU cache with optional TTL and hit/miss/eviction counters"""
+
+    def __init__(self, max_entries=128, max_bytes=None, size_of=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_of = size_of or (lambda value: len(value) if isinstance(value, (str, bytes)) else 1)
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._expires = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if it is not cached."""
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            if key in self._expires and self._expires[key] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+
+    def set(self, key, value):
+        """Store a value, evicting least recently used entries if over capacity."""
+        size = self.size_of(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            # Values larger than the whole cache are never stored
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            if self.ttl is not None:
+                self._expires[key] = time.monotonic() + self.ttl
+            while self._data and (
+                (self.max_entries is not None and len(self._data) > self.max_entries)
+                or (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        del self._data[key]
+        self._bytes -= self._sizes.pop(key)
+        self._expires.pop(key, None)
+
+    def delete(self, key):
+        """Remove a key from the cache if present."""
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        """Remove all entries (counters are kept)."""
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._expires.clear()
+            self._bytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        """Return cache counters for sizing and monitoring."""
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class DiskCache:
+    """JSON-file-per-key cache in a directory, safe to share between processes"""
+
+    def __init__(self, directory, ttl=None):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name[:2], f"{name}.json")
+
+    def get(self, key, default=None):
+        """Return the stored value for key, or default if it is missing or unreadable."""
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+            if entry.get("key") != key:
+                raise KeyError(key)
+            if entry.get("expires_at") is not None and entry["expires_at"] <= time.time():
+                raise KeyError(key)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return default
+        with self._lock:
+            self.hits += 1
+        return entry["value"]
+
+    def set(self, key, value):
+        """Store a JSON-serialisable value; writes are atomic via rename."""
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump({
+                    "key": key,
+                    "value": value,
+                    "expires_at": time.time() + self.ttl if self.ttl is not None else None
+                }, file)
+            os.replace(temp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            with self._lock:
+                self.errors += 1
+            print(f"Error writing disk cache entry: {str(e)}")
+
+    def stats(self):
+        """Return disk cache counters."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "errors": self.errors}
+
+
+class TieredCache:
+    """In-memory LRU cache backed by an optional on-disk tier"""
+
+    def __init__(self, max_entries=128, max_bytes=None, directory=None, size_of=None, ttl=None):
+        self.memory = LRUCache(max_entries=max_entries, max_bytes=max_bytes, size_of=size_of, ttl=ttl)
+        self.disk = DiskCache(directory, ttl=ttl) if directory else None
+
+    def get(self, key, default=None):
+        """Look a key up in memory, then on disk (promoting disk hits to memory)."""
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+                return value
+        return default
+
+    def set(self, key, value):
+        """Store a value in every tier."""
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self):
+        """Clear the in-memory tier."""
+        self.memory.clear()
+
+    def stats(self):
+        """Return counters for every tier."""
+        stats = {"memory": self.memory.stats()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
@@ -1,6 +1,5 @@
 import gradio as gr
 import base64
-from PIL import Image
 import io
 
 def create_company_info_ui():
@@ -55,6 +54,7 @@ def create_company_info_ui():
             if file is None:
                 return None, gr.update(visible=False)
             try:
+                from PIL import Image
                 img = Image.open(file.name)
                 return img, gr.update(visible=True)
             except Exception as e:
@@ -26,32 +26,9 @@ Always conclude with actionable insights, clear opinions, and the basis for thos
         
         return "Quick Response"
     
-    def chat(self, message, session_id):
-        """Override chat to include response type determination"""
-        if not message.strip():
-            return "Please provide a message."
-            
-        if session_id not in self.conversation_history:
-            self.conversation_history[session_id] = []
-        
+    def format_user_message(self, message):
+        """Add the response type instruction to the user message"""
         # Determine response type
         response_type = self.analyze_prompt(message)
         
-        # Add user message to conversation history with instruction
-        prompt_with_instruction = f"{message}\n\nPlease provide a {response_type}."
-        self.conversation_history[session_id].append({
-            "role": "user",
-            "content": prompt_with_instruction
-        })
-        
-        # Get response from LLM
-        messages = [{"role": "system", "content": self.system_prompt}] + self.conversation_history[session_id]
-        response = self.llm_service.get_chat_response(messages)
-        
-        # Add response to conversation history
-        self.conversation_history[session_id].append({
-            "role": "assistant",
-            "content": response
-        })
-        
-        return response
+        return f"{message}\n\nPlease provide a {response_type}."
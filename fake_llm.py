@@ -0,0 +1,131 @@
+import os
+import time
+import random
+import asyncio
+import hashlib
+from types import SimpleNamespace
+
+# Vocabulary for generated responses
+_WORDS = (
+    "audit revenue liability asset ledger balance invoice tax provision depreciation "
+    "materiality control risk disclosure compliance statement reconciliation accrual "
+    "deferred expense income cash equity interest payable receivable variance"
+).split()
+
+
+class FakeLLMError(Exception):
+    """Injected failure, shaped like an API status error"""
+
+    def __init__(self, message, status_code=503, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+        self.response = SimpleNamespace(status_code=status_code, headers=headers)
+
+
+class FakeLLMBackend:
+    """Offline stand-in for the Groq chat completions API.
+
+    Simulates time to first token, a token rate and injected errors, and
+    returns deterministic text so runs are comparable.
+    """
+
+    def __init__(self, latency=0.2, tokens_per_second=250.0, completion_tokens=200,
+                 error_rate=0.0, rate_limit_rate=0.0, seed=None):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self._random = random.Random(seed)
+        self.calls = 0
+
+    @classmethod
+    def from_env(cls):
+        """Build a backend configured by DATALIS_FAKE_LLM_* environment variables."""
+        return cls(
+            latency=float(os.environ.get("DATALIS_FAKE_LLM_LATENCY_MS", 200)) / 1000,
+            tokens_per_second=float(os.environ.get("DATALIS_FAKE_LLM_TOKENS_PER_SECOND", 250)),
+            completion_tokens=int(os.environ.get("DATALIS_FAKE_LLM_COMPLETION_TOKENS", 200)),
+            error_rate=float(os.environ.get("DATALIS_FAKE_LLM_ERROR_RATE", 0)),
+            rate_limit_rate=float(os.environ.get("DATALIS_FAKE_LLM_RATE_LIMIT_RATE", 0)),
+        )
+
+    def _check_failure(self):
+        self.calls += 1
+        roll = self._random.random()
+        if roll < self.rate_limit_rate:
+            raise FakeLLMError("Rate limit reached (injected)", status_code=429, retry_after=1)
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise FakeLLMError("Service unavailable (injected)", status_code=503)
+
+    def _tokens(self, messages, max_tokens):
+        """Deterministic response tokens derived from the request."""
+        digest = hashlib.sha256(repr(messages).encode('utf-8')).digest()
+        count = min(max_tokens or self.completion_tokens, self.completion_tokens)
+        return [_WORDS[(digest[i % len(digest)] + i) % len(_WORDS)] + " " for i in range(count)]
+
+    def _usage(self, messages, completion_tokens):
+        prompt_tokens = sum(len(message.get("content") or "") for message in messages) // 4
+        return SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens
+        )
+
+    def _completion(self, messages, tokens):
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content="".join(tokens)))],
+            usage=self._usage(messages, len(tokens))
+        )
+
+    @staticmethod
+    def _chunk(text):
+        return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+    def create(self, messages, model=None, temperature=None, max_tokens=None, stream=False, **kwargs):
+        """Synchronous chat completion."""
+        self._check_failure()
+        tokens = self._tokens(messages, max_tokens)
+        time.sleep(self.latency)
+        if stream:
+            return self._stream(tokens)
+        time.sleep(len(tokens) / self.tokens_per_second)
+        return self._completion(messages, tokens)
+
+    def _stream(self, tokens):
+        for token in tokens:
+            time.sleep(1 / self.tokens_per_second)
+            yield self._chunk(token)
+
+    async def acreate(self, messages, model=None, temperature=None, max_tokens=None, stream=False, **kwargs):
+        """Asynchronous chat completion."""
+        self._check_failure()
+        tokens = self._tokens(messages, max_tokens)
+        await asyncio.sleep(self.latency)
+        if stream:
+            return self._astream(tokens)
+        await asyncio.sleep(len(tokens) / self.tokens_per_second)
+        return self._completion(messages, tokens)
+
+    async def _astream(self, tokens):
+        for token in tokens:
+            await asyncio.sleep(1 / self.tokens_per_second)
+            yield self._chunk(token)
+
+
+class FakeGroq:
+    """Drop-in replacement for groq.Groq backed by a FakeLLMBackend"""
+
+    def __init__(self, backend=None):
+        self.backend = backend or FakeLLMBackend.from_env()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.backend.create))
+
+
+class AsyncFakeGroq:
+    """Drop-in replacement for groq.AsyncGroq backed by a FakeLLMBackend"""
+
+    def __init__(self, backend=None):
+        self.backend = backend or FakeLLMBackend.from_env()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.backend.acreate))
@@ -1,101 +1,465 @@
-import os
-import pandas as pd
-import docx
-import PyPDF2
-import tempfile
-from pathlib import Path
-
-class FileHandler:
-    """Common file handling functionality for all agents"""
-    
-    @staticmethod
-    def extract_text_from_pdf(file_path):
-        """Extract text from PDF files."""
-        text = ""
-        try:
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                for page_num in range(len(pdf_reader.pages)):
-                    text += pdf_reader.pages[page_num].extract_text()
-        except Exception as e:
-            text = f"Error extracting PDF content: {str(e)}"
-        return text
-
-    @staticmethod
-    def extract_text_from_docx(file_path):
-        """Extract text from DOCX files."""
-        try:
-            doc = docx.Document(file_path)
-            return "\n".join([paragraph.text for paragraph in doc.paragraphs])
-        except Exception as e:
-            return f"Error extracting DOCX content: {str(e)}"
-
-    @staticmethod
-    def extract_text_from_txt(file_path):
-        """Extract text from TXT files."""
-        try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                return file.read()
-        except Exception as e:
-            return f"Error extracting TXT content: {str(e)}"
-
-    @staticmethod
-    def extract_data_from_csv(file_path):
-        """Extract data from CSV files."""
-        try:
-            df = pd.read_csv(file_path)
-            return df.to_string()
-        except Exception as e:
-            return f"Error extracting CSV content: {str(e)}"
-
-    @staticmethod
-    def extract_data_from_excel(file_path):
-        """Extract data from Excel files."""
-        try:
-            df = pd.read_excel(file_path)
-            return df.to_string()
-        except Exception as e:
-            return f"Error extracting Excel content: {str(e)}"
-
-    @staticmethod
-    def process_file(file_path):
-        """Process a file and extract its content based on file type."""
-        if not os.path.exists(file_path):
-            return f"File not found: {file_path}"
-            
-        file_extension = os.path.splitext(file_path)[1].lower()
-        
-        if file_extension == '.pdf':
-            return FileHandler.extract_text_from_pdf(file_path)
-        elif file_extension == '.docx':
-            return FileHandler.extract_text_from_docx(file_path)
-        elif file_extension == '.txt':
-            return FileHandler.extract_text_from_txt(file_path)
-        elif file_extension == '.csv':
-            return FileHandler.extract_data_from_csv(file_path)
-        elif file_extension in ['.xls', '.xlsx']:
-            return FileHandler.extract_data_from_excel(file_path)
-        else:
-            return f"Unsupported file format: {file_extension}"
-    
-    @staticmethod
-    def handle_uploaded_files(files, session_id, uploaded_files_dict):
-        """Process uploaded files and store their information."""
-        if session_id not in uploaded_files_dict:
-            uploaded_files_dict[session_id] = []
-        
-        file_list = []
-        for file in files:
-            # Store the actual file object and its path
-            file_path = file.name
-            file_name = os.path.basename(file_path)
-            
-            # Save the file info
-            uploaded_files_dict[session_id].append({
-                "name": file_name,
-                "path": file_path,
-                "type": os.path.splitext(file_name)[1]
-            })
-            file_list.append(file_name)
-        
-        return file_list
+import os
+import shutil
+import threading
+import multiprocessing
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+import tracing
+from cache import TieredCache, hash_file
+from session_store import session_upload_dir
+from vector_index import VECTOR_INDEX
+from keyword_index import KEYWORD_INDEX
+
+# Parsers (PyPDF2, python-docx, and pandas through tabular) are imported by
+# the extractors on first use, so starting the app does not pay for them
+
+# Bump when extractor output changes so stale cache entries are not reused
+EXTRACTION_VERSION = 3
+
+# Content-addressed cache of extracted text, shared by all sessions and agents
+EXTRACTION_CACHE = TieredCache(
+    max_entries=int(os.environ.get("DATALIS_EXTRACTION_CACHE_ENTRIES", 64)),
+    max_bytes=int(os.environ.get("DATALIS_EXTRACTION_CACHE_MB", 256)) * 1024 * 1024,
+    directory=os.environ.get("DATALIS_EXTRACTION_CACHE_DIR") or None
+)
+tracing.register_stats("extraction_cache", EXTRACTION_CACHE.stats)
+# Extractions in progress; concurrent callers for the same content wait for the same result
+_extractions = {}
+_extractions_lock = threading.Lock()
+
+def _usable_cpus():
+    """Return the CPUs this process can run on, honouring CPU affinity and a cgroup v2 quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max", 'r') as file:
+            quota, period = file.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+# PDFs with at least this many pages are extracted in a process pool
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("DATALIS_PDF_PARALLEL_MIN_PAGES", 40))
+# os.cpu_count() reports the host's CPUs even in a container limited to one or two; workers
+# beyond the CPUs actually available only add overhead, and with one the pool is not used
+PDF_WORKERS = int(os.environ.get("DATALIS_PDF_WORKERS", min(4, _usable_cpus())))
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool():
+    """Return the shared PDF extraction process pool, starting it on first use."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # Forking a process that runs many threads can copy a held lock into the child and
+            # deadlock it, so workers start from a clean server (spawned where there is none)
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            context = multiprocessing.get_context(method)
+            if method == "forkserver":
+                # The server only needs the extractor, not the app's __main__ module
+                context.set_forkserver_preload(["file_handler"])
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=context)
+        return _pdf_pool
+
+def _extract_pdf_page_range(file_path, start, end):
+    """Extract the text of pages [start, end) of a PDF (runs in worker processes)."""
+    import PyPDF2
+    with open(file_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        return [pdf_reader.pages[page_num].extract_text() or "" for page_num in range(start, end)]
+
+class FileHandler:
+    """Common file handling functionality for all agents"""
+    
+    @staticmethod
+    def extract_text_from_pdf(file_path):
+        """Extract text from PDF files."""
+        result = FileHandler.extract_pdf_pages(file_path)
+        if "error" in result:
+            return f"Error extracting PDF content: {result['error']}"
+        return result["text"]
+
+    @staticmethod
+    def extract_pdf_pages(file_path, parallel=None):
+        """Extract PDF text along with page boundaries.
+
+        Large PDFs are split into page ranges and extracted in a process pool;
+        small ones are read serially since pool startup would dominate.
+        Returns a dict with "text", "page_count" and "page_offsets" (the start
+        offset of each page in "text"), or "error" on failure.
+        """
+        try:
+            import PyPDF2
+            with open(file_path, 'rb') as file:
+                pdf_reader = PyPDF2.PdfReader(file)
+                page_count = len(pdf_reader.pages)
+                
+                if parallel is None:
+                    parallel = page_count >= PDF_PARALLEL_MIN_PAGES and PDF_WORKERS > 1
+                
+                page_texts = None
+                if parallel and page_count > 1:
+                    try:
+                        page_texts = FileHandler._extract_pdf_pages_parallel(file_path, page_count)
+                    except Exception as e:
+                        # A broken or unavailable pool should not fail the upload
+                        print(f"Parallel PDF extraction failed, falling back to serial: {str(e)}")
+                
+                if page_texts is None:
+                    page_texts = [page.extract_text() or "" for page in pdf_reader.pages]
+        except Exception as e:
+            return {"error": str(e)}
+        
+        # Record where each page starts, then join once
+        page_offsets = []
+        offset = 0
+        for page_text in page_texts:
+            page_offsets.append(offset)
+            offset += len(page_text)
+        
+        return {
+            "text": "".join(page_texts),
+            "page_count": page_count,
+            "page_offsets": page_offsets
+        }
+
+    @staticmethod
+    def _extract_pdf_pages_parallel(file_path, page_count):
+        """Split the page range across the PDF worker pool and collect page texts in order."""
+        workers = min(PDF_WORKERS, page_count)
+        step = -(-page_count // workers)
+        ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+        
+        pool = _get_pdf_pool()
+        futures = [pool.submit(_extract_pdf_page_range, file_path, start, end) for start, end in ranges]
+        
+        page_texts = []
+        for future in futures:
+            page_texts.extend(future.result())
+        return page_texts
+
+    @staticmethod
+    def extract_text_from_docx(file_path):
+        """Extract text from DOCX files."""
+        try:
+            import docx
+            doc = docx.Document(file_path)
+            return "\n".join([paragraph.text for paragraph in doc.paragraphs])
+        except Exception as e:
+            return f"Error extracting DOCX content: {str(e)}"
+
+    @staticmethod
+    def extract_text_from_txt(file_path):
+        """Extract text from TXT files."""
+        try:
+            with open(file_path, 'r', encoding='utf-8') as file:
+                return file.read()
+        except Exception as e:
+            return f"Error extracting TXT content: {str(e)}"
+
+    @staticmethod
+    def extract_data_from_csv(file_path):
+        """Extract a compact summary (schema, row count, numeric totals, head/tail rows) from CSV files."""
+        try:
+            from tabular import summarize_tabular_file
+            return summarize_tabular_file(file_path)
+        except Exception as e:
+            return f"Error extracting CSV content: {str(e)}"
+
+    @staticmethod
+    def extract_data_from_excel(file_path):
+        """Extract a compact summary of every sheet from Excel files."""
+        try:
+            from tabular import summarize_tabular_file
+            return summarize_tabular_file(file_path)
+        except Exception as e:
+            return f"Error extracting Excel content: {str(e)}"
+
+    @staticmethod
+    def process_file(file_path):
+        """Process a file and extract its content based on file type."""
+        if not os.path.exists(file_path):
+            return f"File not found: {file_path}"
+            
+        file_extension = os.path.splitext(file_path)[1].lower()
+        
+        with tracing.span("file.process", format=file_extension) as span:
+            # Identical content is only parsed once, whatever its path, session or
+            # caller (the upload pipeline and both retrieval indexes ask at once)
+            cache_key = FileHandler.extraction_cache_key(file_path)
+            with _extractions_lock:
+                cached = EXTRACTION_CACHE.get(cache_key)
+                extraction = _extractions.get(cache_key) if cached is None else None
+                owner = cached is None and extraction is None
+                if owner:
+                    extraction = _extractions[cache_key] = Future()
+            span.set(cache_hit=not owner)
+            if cached is not None:
+                return cached
+            if not owner:
+                content = extraction.result()
+                # The other caller's copy may have failed (e.g. its session ended), so retry with this path
+                if not FileHandler.is_extraction_error(content):
+                    return content
+                return FileHandler._extract_and_cache(file_path, file_extension, cache_key, span)
+            
+            try:
+                content = FileHandler._extract_and_cache(file_path, file_extension, cache_key, span)
+                extraction.set_result(content)
+                return content
+            except Exception as e:
+                extraction.set_exception(e)
+                raise
+            finally:
+                with _extractions_lock:
+                    _extractions.pop(cache_key, None)
+    
+    @staticmethod
+    def _extract_and_cache(file_path, file_extension, cache_key, span):
+        content = FileHandler.extract_content(file_path, file_extension)
+        span.set(chars=len(content))
+        
+        # Error messages are not cached so a transient failure can be retried
+        if not FileHandler.is_extraction_error(content):
+            EXTRACTION_CACHE.set(cache_key, content)
+        return content
+    
+    @staticmethod
+    def extraction_cache_key(file_path):
+        """Build the content-addressed cache key for a file."""
+        file_extension = os.path.splitext(file_path)[1].lower()
+        return f"{hash_file(file_path)}{file_extension}:v{EXTRACTION_VERSION}"
+    
+    @staticmethod
+    def is_extraction_error(content):
+        """Check whether extracted content is an error message rather than text."""
+        return content.startswith(("Error extracting", "Unsupported file format", "File not found"))
+    
+    @staticmethod
+    def extraction_cache_stats():
+        """Return hit/miss/eviction counters for the extraction cache."""
+        return EXTRACTION_CACHE.stats()
+    
+    @staticmethod
+    def extract_content(file_path, file_extension):
+        """Run the extractor matching the file extension, bypassing the cache."""
+        # One span name per format, so each extractor gets its own metrics
+        with tracing.span(f"file.extract{file_extension}") as span:
+            content = FileHandler._run_extractor(file_path, file_extension)
+            span.set(failed=FileHandler.is_extraction_error(content))
+            return content
+    
+    @staticmethod
+    def _run_extractor(file_path, file_extension):
+        if file_extension == '.pdf':
+            return FileHandler.extract_text_from_pdf(file_path)
+        elif file_extension == '.docx':
+            return FileHandler.extract_text_from_docx(file_path)
+        elif file_extension == '.txt':
+            return FileHandler.extract_text_from_txt(file_path)
+        elif file_extension == '.csv':
+            return FileHandler.extract_data_from_csv(file_path)
+        elif file_extension in ['.xls', '.xlsx']:
+            return FileHandler.extract_data_from_excel(file_path)
+        else:
+            return f"Unsupported file format: {file_extension}"
+    
+    @staticmethod
+    def iter_file_content(file_path, block_chars=4000):
+        """Yield a file's content lazily: pages for PDF, paragraphs for DOCX,
+        fixed-size blocks for TXT and one compact summary per sheet for CSV/Excel.
+
+        Callers can stop iterating once they have enough text, so only the
+        part of the document that is actually read gets parsed. Errors are
+        yielded as a single message block, matching process_file.
+        """
+        if not os.path.exists(file_path):
+            yield f"File not found: {file_path}"
+            return
+        
+        file_extension = os.path.splitext(file_path)[1].lower()
+        
+        # Already-extracted documents are served from the cache
+        cached = EXTRACTION_CACHE.get(FileHandler.extraction_cache_key(file_path))
+        if cached is not None:
+            for start in range(0, len(cached), block_chars):
+                yield cached[start:start + block_chars]
+            return
+        
+        if file_extension == '.pdf':
+            blocks = FileHandler._iter_pdf_pages(file_path)
+        elif file_extension == '.docx':
+            blocks = FileHandler._iter_docx_paragraphs(file_path)
+        elif file_extension == '.txt':
+            blocks = FileHandler._iter_txt_blocks(file_path, block_chars)
+        elif file_extension == '.csv':
+            blocks = FileHandler._iter_tabular_summary(file_path, "CSV")
+        elif file_extension in ['.xls', '.xlsx']:
+            blocks = FileHandler._iter_tabular_summary(file_path, "Excel")
+        else:
+            yield f"Unsupported file format: {file_extension}"
+            return
+        
+        yield from blocks
+    
+    @staticmethod
+    def _iter_pdf_pages(file_path):
+        """Yield PDF text page by page."""
+        try:
+            import PyPDF2
+            with open(file_path, 'rb') as file:
+                pdf_reader = PyPDF2.PdfReader(file)
+                for page in pdf_reader.pages:
+                    yield page.extract_text() or ""
+        except Exception as e:
+            yield f"Error extracting PDF content: {str(e)}"
+    
+    @staticmethod
+    def _iter_docx_paragraphs(file_path):
+        """Yield DOCX paragraphs, newline separated."""
+        try:
+            import docx
+            doc = docx.Document(file_path)
+        except Exception as e:
+            yield f"Error extracting DOCX content: {str(e)}"
+            return
+        for index, paragraph in enumerate(doc.paragraphs):
+            yield paragraph.text if index == 0 else "\n" + paragraph.text
+    
+    @staticmethod
+    def _iter_txt_blocks(file_path, block_chars):
+        """Yield a text file in fixed-size blocks."""
+        try:
+            with open(file_path, 'r', encoding='utf-8') as file:
+                for block in iter(lambda: file.read(block_chars), ''):
+                    yield block
+        except Exception as e:
+            yield f"Error extracting TXT content: {str(e)}"
+    
+    @staticmethod
+    def _iter_tabular_summary(file_path, error_label):
+        """Yield the compact summary and computed facts of each sheet of a CSV or Excel file."""
+        try:
+            from tabular import analyze_chunks, iter_tabular_chunks
+            sheets = analyze_chunks(iter_tabular_chunks(file_path))
+        except Exception as e:
+            yield f"Error extracting {error_label} content: {str(e)}"
+            return
+        for index, (summary, analysis) in enumerate(sheets):
+            text = summary.render() + "\n" + analysis.render()
+            yield text if index == 0 else "\n\n" + text
+    
+    @staticmethod
+    def extract_material_items(file_path, thresholds):
+        """Material line items of a CSV or Excel file under the given
+        materiality.MaterialityThresholds, with trivial items aggregated; "" for other types."""
+        if not FileHandler.is_tabular_file(file_path) or not os.path.exists(file_path):
+            return ""
+        
+        cache_key = FileHandler.extraction_cache_key(file_path) + ":material:" + thresholds.key()
+        cached = EXTRACTION_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        try:
+            from tabular import material_items_for_file
+            material_items = material_items_for_file(file_path, thresholds)
+        except Exception as e:
+            return f"Error applying materiality thresholds: {str(e)}"
+        EXTRACTION_CACHE.set(cache_key, material_items)
+        return material_items
+    
+    @staticmethod
+    def is_tabular_file(file_path):
+        """Whether a file is a CSV or Excel upload."""
+        return os.path.splitext(file_path)[1].lower() in ['.csv', '.xls', '.xlsx']
+    
+    @staticmethod
+    def take_text(document, max_chars):
+        """Return up to max_chars of a document given as a string or an
+        iterable of text blocks, stopping the iteration as soon as possible."""
+        if isinstance(document, str):
+            return document[:max_chars]
+        
+        parts = []
+        length = 0
+        try:
+            for block in document:
+                parts.append(block)
+                length += len(block)
+                if length >= max_chars:
+                    break
+        finally:
+            # Release the underlying file as soon as we have enough
+            if hasattr(document, 'close'):
+                document.close()
+        return "".join(parts)[:max_chars]
+    
+    @staticmethod
+    def read_file_prefix(file_path, max_chars):
+        """Extract only the first max_chars characters of a file."""
+        return FileHandler.take_text(FileHandler.iter_file_content(file_path), max_chars)
+    
+    @staticmethod
+    def extract_for_index(file_path):
+        """Full extracted text of a file for retrieval indexing; None if it cannot be extracted."""
+        content = FileHandler.process_file(file_path)
+        return None if FileHandler.is_extraction_error(content) else content
+    
+    @staticmethod
+    def store_upload(source_path, session_id):
+        """Give a session its own copy of an uploaded file (a hard link when possible), so
+        ending one session never deletes a file another session uploaded too."""
+        directory = session_upload_dir(session_id)
+        os.makedirs(directory, exist_ok=True)
+        # A directory per upload keeps files with the same name apart
+        file_path = os.path.join(tempfile.mkdtemp(dir=directory), os.path.basename(source_path))
+        try:
+            os.link(source_path, file_path)
+        except OSError:
+            shutil.copy2(source_path, file_path)
+        return file_path
+    
+    @staticmethod
+    def handle_uploaded_files(files, session_id, uploaded_files_dict):
+        """Process uploaded files and store their information."""
+        if session_id not in uploaded_files_dict:
+            uploaded_files_dict[session_id] = []
+        
+        # The upload component passes every file it holds, not just the new ones
+        known_paths = {info.get("source", info["path"]) for info in uploaded_files_dict[session_id]}
+        
+        file_list = []
+        for file in files:
+            # Store the actual file object and its path
+            source_path = file.name
+            file_name = os.path.basename(source_path)
+            
+            if source_path in known_paths:
+                file_list.append(file_name)
+                continue
+            known_paths.add(source_path)
+            file_path = FileHandler.store_upload(source_path, session_id)
+            
+            # Save the file info
+            uploaded_files_dict[session_id].append({
+                "name": file_name,
+                "path": file_path,
+                "source": source_path,
+                "type": os.path.splitext(file_name)[1]
+            })
+            file_list.append(file_name)
+            
+            # Index the file for retrieval in the background
+            content_key = FileHandler.extraction_cache_key(file_path)
+            load_text = lambda path=file_path: FileHandler.extract_for_index(path)
+            VECTOR_INDEX.add_document(session_id, file_name, content_key, load_text)
+            KEYWORD_INDEX.add_document(session_id, file_name, content_key, load_text)
+        
+        return file_list
@@ -0,0 +1,275 @@
+import re
+import numpy as np
+import pandas as pd
+
+# Column name patterns used to find the roles of ledger / trial balance columns
+DEBIT_PATTERN = re.compile(r"debit|\bdr\b", re.IGNORECASE)
+CREDIT_PATTERN = re.compile(r"credit|\bcr\b", re.IGNORECASE)
+PERIOD_PATTERN = re.compile(r"date|period|month|quarter|\byear\b|\bfy\b", re.IGNORECASE)
+ACCOUNT_PATTERN = re.compile(r"account|ledger|head|particular|description|name|gl", re.IGNORECASE)
+# Numeric columns that are identifiers rather than amounts
+IDENTIFIER_PATTERN = re.compile(r"\bid\b|\bno\b|number|code|voucher|invoice|year|pin|phone|serial|sr", re.IGNORECASE)
+
+# Expected Benford first-digit frequencies for digits 1-9
+BENFORD_EXPECTED = np.log10(1 + 1 / np.arange(1, 10))
+# Nigrini's mean absolute deviation conformity thresholds for first digits
+BENFORD_MAD_THRESHOLDS = [(0.006, "close conformity"), (0.012, "acceptable conformity"),
+                          (0.015, "marginal conformity")]
+# Values further than this many standard deviations from the mean are flagged
+OUTLIER_Z = 3.0
+# Largest values kept per column as outlier candidates
+OUTLIER_CANDIDATES = 20
+# Distinct periods tracked before period analysis is abandoned
+MAX_PERIODS = 120
+# Periods shown in the rendered period-over-period changes
+RENDERED_PERIODS = 12
+# Outliers shown per column in the rendered facts
+RENDERED_OUTLIERS = 5
+# Allowed debit/credit difference, as a fraction of total debits
+BALANCE_TOLERANCE = 0.005
+
+
+def first_digits(values):
+    """Vectorized first significant digit (1-9) of the non-zero values."""
+    values = np.abs(values[np.isfinite(values)])
+    values = values[values > 0]
+    if not len(values):
+        return np.array([], dtype=int)
+    digits = np.floor(values / 10 ** np.floor(np.log10(values))).astype(int)
+    # Guard against floating point edge cases such as 9.999... -> 10
+    return np.clip(digits, 1, 9)
+
+
+def detect_column_roles(chunk):
+    """Guess the amount, debit, credit, period and account columns of a ledger-like table."""
+    columns = list(chunk.columns)
+    numeric = [column for column in columns if pd.api.types.is_numeric_dtype(chunk[column])]
+    text = [column for column in columns if column not in numeric]
+
+    period = next((column for column in columns if PERIOD_PATTERN.search(str(column))), None)
+    numeric = [column for column in numeric if column != period]
+    debit = next((column for column in numeric if DEBIT_PATTERN.search(str(column))), None)
+    credit = next((column for column in numeric if CREDIT_PATTERN.search(str(column))), None)
+    return {
+        "amount": [
+            column for column in numeric
+            if column in (debit, credit) or not IDENTIFIER_PATTERN.search(str(column))
+        ],
+        "debit": debit,
+        "credit": credit,
+        "period": period,
+        "account": next(
+            (column for column in text if ACCOUNT_PATTERN.search(str(column)) and column != period), None
+        ),
+    }
+
+
+class FinancialPreAnalysis:
+    """Single-pass, vectorized financial checks over a table read in chunks.
+
+    Computes column totals, debit/credit balance, period-over-period deltas,
+    Benford first-digit distributions and outlier flags, so prompts can quote
+    exact figures instead of asking the LLM to add up raw rows.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.columns = None
+        self.amount_columns = []
+        self.debit_column = None
+        self.credit_column = None
+        self.period_column = None
+        self.account_column = None
+        self.row_count = 0
+        self.totals = None
+        self.counts = None
+        self.sum_squares = None
+        self.period_totals = None
+        self.digit_counts = np.zeros(10, dtype=np.int64)
+        self.candidates = {}
+
+    def _detect_columns(self, chunk):
+        self.columns = list(chunk.columns)
+        roles = detect_column_roles(chunk)
+        self.amount_columns = roles["amount"]
+        self.debit_column = roles["debit"]
+        self.credit_column = roles["credit"]
+        self.period_column = roles["period"]
+        self.account_column = roles["account"]
+
+        self.totals = pd.Series(0.0, index=self.amount_columns)
+        self.counts = pd.Series(0, index=self.amount_columns, dtype="int64")
+        self.sum_squares = pd.Series(0.0, index=self.amount_columns)
+        self.period_totals = pd.DataFrame(columns=self.amount_columns, dtype="float64")
+
+    def _period_keys(self, values):
+        """Map period column values to sortable period labels (YYYY-MM for dates)."""
+        if pd.api.types.is_numeric_dtype(values):
+            return values.round().astype("Int64").astype(str)
+        dates = pd.to_datetime(values, errors="coerce")
+        if dates.notna().mean() >= 0.8:
+            return dates.dt.strftime("%Y-%m")
+        return values.astype(str)
+
+    def update(self, chunk):
+        """Fold a DataFrame chunk into the running analysis."""
+        if self.columns is None:
+            self._detect_columns(chunk)
+        if not self.amount_columns:
+            self.row_count += len(chunk)
+            return
+
+        chunk = chunk.reindex(columns=self.columns)
+        amounts = chunk[self.amount_columns].apply(pd.to_numeric, errors="coerce")
+        self.row_count += len(chunk)
+
+        # Totals and moments for outlier thresholds
+        self.totals += amounts.sum()
+        self.counts += amounts.count()
+        self.sum_squares += (amounts ** 2).sum()
+
+        # Period totals
+        if self.period_column is not None:
+            periods = self._period_keys(chunk[self.period_column])
+            grouped = amounts.groupby(periods.values).sum()
+            self.period_totals = grouped.add(self.period_totals, fill_value=0) if len(self.period_totals) else grouped
+            # A column with this many distinct values is not a reporting period
+            if len(self.period_totals) > MAX_PERIODS:
+                self.period_column = None
+                self.period_totals = self.period_totals.iloc[0:0]
+
+        # Benford first-digit counts over every amount in the chunk
+        self.digit_counts += np.bincount(first_digits(amounts.to_numpy(dtype="float64").ravel()), minlength=10)
+
+        # Keep the largest absolute values of each column as outlier candidates
+        for column in self.amount_columns:
+            values = amounts[column].dropna()
+            if not len(values):
+                continue
+            top = values.abs().nlargest(OUTLIER_CANDIDATES).index
+            rows = pd.DataFrame({"value": values.loc[top]})
+            if self.account_column is not None:
+                rows["account"] = chunk.loc[top, self.account_column].astype(str).values
+            if column in self.candidates:
+                rows = pd.concat([self.candidates[column], rows], ignore_index=True)
+            else:
+                rows = rows.reset_index(drop=True)
+            self.candidates[column] = rows.loc[rows["value"].abs().nlargest(OUTLIER_CANDIDATES).index]
+
+    def facts(self):
+        """Return the computed facts as a dict."""
+        facts = {"table": self.name, "rows": self.row_count, "amount_columns": list(self.amount_columns)}
+        if not self.amount_columns:
+            return facts
+
+        facts["totals"] = {column: float(self.totals[column]) for column in self.amount_columns}
+
+        if self.debit_column is not None and self.credit_column is not None:
+            debits = float(self.totals[self.debit_column])
+            credits = float(self.totals[self.credit_column])
+            difference = debits - credits
+            facts["balance_check"] = {
+                "debit_column": self.debit_column,
+                "credit_column": self.credit_column,
+                "total_debits": debits,
+                "total_credits": credits,
+                "difference": difference,
+                "balanced": abs(difference) <= max(abs(debits) * BALANCE_TOLERANCE, 1.0),
+            }
+
+        if self.period_column is not None and len(self.period_totals) > 1:
+            periods = self.period_totals.sort_index()
+            deltas = periods.diff()
+            changes = periods.pct_change(fill_method=None).replace([np.inf, -np.inf], np.nan) * 100
+            facts["periods"] = {
+                "column": self.period_column,
+                "totals": {str(period): row.round(2).to_dict() for period, row in periods.iterrows()},
+                "deltas": {str(period): row.round(2).to_dict() for period, row in deltas.iloc[1:].iterrows()},
+                "percent_changes": {
+                    str(period): row.round(1).to_dict() for period, row in changes.iloc[1:].iterrows()
+                },
+            }
+
+        total_digits = int(self.digit_counts[1:].sum())
+        if total_digits:
+            observed = self.digit_counts[1:] / total_digits
+            mad = float(np.mean(np.abs(observed - BENFORD_EXPECTED)))
+            conformity = next((label for limit, label in BENFORD_MAD_THRESHOLDS if mad <= limit), "nonconformity")
+            facts["benford"] = {
+                "values_tested": total_digits,
+                "observed": {str(digit): round(float(share), 4) for digit, share in enumerate(observed, start=1)},
+                "expected": {str(digit): round(float(share), 4) for digit, share in enumerate(BENFORD_EXPECTED, start=1)},
+                "mad": round(mad, 5),
+                "conformity": conformity,
+            }
+
+        outliers = []
+        for column in self.amount_columns:
+            count = int(self.counts[column])
+            if count < 3 or column not in self.candidates:
+                continue
+            mean = self.totals[column] / count
+            variance = max(self.sum_squares[column] / count - mean ** 2, 0.0)
+            std = variance ** 0.5
+            if not std:
+                continue
+            rows = self.candidates[column]
+            z_scores = (rows["value"] - mean) / std
+            for index in np.flatnonzero(np.abs(z_scores.to_numpy()) > OUTLIER_Z):
+                outlier = {"column": column, "value": float(rows["value"].iloc[index]),
+                           "z_score": round(float(z_scores.iloc[index]), 1)}
+                if "account" in rows:
+                    outlier["account"] = rows["account"].iloc[index]
+                outliers.append(outlier)
+        facts["outliers"] = outliers
+        return facts
+
+    def render(self):
+        """Render the facts as prompt text."""
+        facts = self.facts()
+        if not facts["amount_columns"]:
+            return f"Computed facts for {self.name}: no amount columns found."
+
+        lines = [f"Computed facts for {self.name} (exact, over all {facts['rows']:,} rows):"]
+        lines.append("  Totals: " + ", ".join(f"{column}={total:,.2f}" for column, total in facts["totals"].items()))
+
+        balance = facts.get("balance_check")
+        if balance:
+            status = "BALANCED" if balance["balanced"] else "NOT BALANCED"
+            lines.append(
+                f"  Debit/credit check: debits={balance['total_debits']:,.2f} credits={balance['total_credits']:,.2f} "
+                f"difference={balance['difference']:,.2f} ({status})"
+            )
+
+        periods = facts.get("periods")
+        if periods:
+            lines.append(f"  Period-over-period change by {periods['column']}:")
+            for period, changes in list(periods["percent_changes"].items())[-RENDERED_PERIODS:]:
+                deltas = periods["deltas"][period]
+                lines.append("    " + period + ": " + ", ".join(
+                    f"{column} {deltas[column]:+,.2f} ({changes[column]:+.1f}%)"
+                    if pd.notna(changes[column]) else f"{column} {deltas[column]:+,.2f}"
+                    for column in deltas
+                ))
+
+        benford = facts.get("benford")
+        if benford:
+            lines.append(
+                f"  Benford first-digit test over {benford['values_tested']:,} amounts: MAD={benford['mad']} "
+                f"({benford['conformity']}); observed " + " ".join(
+                    f"{digit}:{share:.3f}" for digit, share in benford["observed"].items()
+                )
+            )
+
+        if facts["outliers"]:
+            lines.append(f"  Outliers (|z| > {OUTLIER_Z:g}, largest first):")
+            for column in self.amount_columns:
+                column_outliers = [outlier for outlier in facts["outliers"] if outlier["column"] == column]
+                for outlier in column_outliers[:RENDERED_OUTLIERS]:
+                    account = f" [{outlier['account']}]" if "account" in outlier else ""
+                    lines.append(f"    {column}={outlier['value']:,.2f}{account} z={outlier['z_score']}")
+                if len(column_outliers) > RENDERED_OUTLIERS:
+                    lines.append(f"    ... and {len(column_outliers) - RENDERED_OUTLIERS} more {column} outliers")
+        else:
+            lines.append("  Outliers: none beyond the z-score threshold.")
+        return "\n".join(lines)
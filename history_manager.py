@@ -0,0 +1,106 @@
+import os
+import threading
+from tokens import count_tokens, count_message_tokens
+
+# Prompt budget for system prompt + history + new message (llama3 context is 8192,
+# and up to 2048 tokens are reserved for the completion)
+HISTORY_TOKEN_BUDGET = int(os.environ.get("DATALIS_HISTORY_TOKEN_BUDGET", 6000))
+# Budget for the note that stands in for dropped turns
+HISTORY_SUMMARY_TOKENS = int(os.environ.get("DATALIS_HISTORY_SUMMARY_TOKENS", 300))
+
+
+class HistoryManager:
+    """Fits conversation history into a token budget and tracks per-session token usage"""
+
+    def __init__(self, max_tokens=HISTORY_TOKEN_BUDGET, summary_tokens=HISTORY_SUMMARY_TOKENS):
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def build_messages(self, session_id, system_prompt, history, user_message):
+        """Return the messages to send: the system prompt, a summary of dropped
+        turns if any, the most recent turns that fit the budget and the new message."""
+        system = {"role": "system", "content": system_prompt}
+        user = {"role": "user", "content": user_message}
+
+        history_tokens = [count_message_tokens(message) for message in history]
+        fixed = count_message_tokens(system) + count_message_tokens(user)
+        available = self.max_tokens - fixed
+
+        # Leave room for the summary note when not everything fits
+        if sum(history_tokens) > available:
+            available -= self.summary_tokens
+
+        # Keep the newest messages that fit, walking back from the end
+        kept_from = len(history)
+        used = 0
+        while kept_from > 0 and used + history_tokens[kept_from - 1] <= available:
+            kept_from -= 1
+            used += history_tokens[kept_from]
+
+        # Never start the kept history on an assistant reply to a dropped question
+        if kept_from < len(history) and history[kept_from]["role"] == "assistant":
+            used -= history_tokens[kept_from]
+            kept_from += 1
+
+        messages = [system]
+        if kept_from > 0:
+            summary = self.summarize(history[:kept_from], self.summary_tokens)
+            if summary:
+                summary_message = {"role": "system", "content": summary}
+                used += count_message_tokens(summary_message)
+                messages.append(summary_message)
+        messages.extend(history[kept_from:])
+        messages.append(user)
+
+        self._record(
+            session_id,
+            sent=fixed + used,
+            trimmed=sum(history_tokens) - used,
+            dropped=kept_from
+        )
+        return messages
+
+    def summarize(self, messages, max_tokens):
+        """Condense dropped messages into a short note listing what the user asked,
+        preferring the most recent questions when they do not all fit."""
+        header = f"Earlier in this conversation ({len(messages)} older messages omitted), the user asked about:"
+        budget = max_tokens - count_tokens(header)
+        questions = []
+        for message in reversed(messages):
+            if message["role"] != "user":
+                continue
+            line = "- " + " ".join(message["content"].split())[:160]
+            cost = count_tokens(line) + 1
+            if cost > budget:
+                break
+            questions.append(line)
+            budget -= cost
+        if not questions:
+            return ""
+        return header + "\n" + "\n".join(reversed(questions))
+
+    def _record(self, session_id, sent, trimmed, dropped):
+        with self._lock:
+            stats = self._stats.setdefault(session_id, {
+                "requests": 0,
+                "prompt_tokens_sent": 0,
+                "tokens_trimmed": 0,
+                "messages_dropped": 0
+            })
+            stats["requests"] += 1
+            stats["prompt_tokens_sent"] += sent
+            stats["tokens_trimmed"] += max(trimmed, 0)
+            # Messages currently outside the window, not a running total
+            stats["messages_dropped"] = dropped
+
+    def stats(self, session_id):
+        """Return token totals for a session."""
+        with self._lock:
+            return dict(self._stats.get(session_id, {}))
+
+    def clear(self, session_id):
+        """Forget the token totals of a session."""
+        with self._lock:
+            self._stats.pop(session_id, None)
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import tracing
+
+# SQLite file holding jobs and their progress and results
+JOB_DB_PATH = os.environ.get("DATALIS_JOB_DB", os.path.join(tempfile.gettempdir(), "datalis_jobs.sqlite3"))
+# Jobs run at the same time across all users
+JOB_WORKERS = int(os.environ.get("DATALIS_JOB_WORKERS", 2))
+# Jobs of one user run at the same time; the rest wait their turn
+JOB_WORKERS_PER_USER = int(os.environ.get("DATALIS_JOB_WORKERS_PER_USER", 1))
+# Queued plus running jobs one user may have before new submissions are refused
+JOB_MAX_PENDING_PER_USER = int(os.environ.get("DATALIS_JOB_MAX_PENDING_PER_USER", 3))
+# Finished jobs are deleted from the database after this long
+JOB_RETENTION_SECONDS = float(os.environ.get("DATALIS_JOB_RETENTION_SECONDS", 24 * 60 * 60))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    progress TEXT NOT NULL DEFAULT '{}',
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+)
+"""
+_COLUMNS = ("id", "kind", "user_id", "status", "params", "progress", "result", "error", "created", "started",
+            "finished")
+
+
+class JobLimitError(Exception):
+    """Raised when a user already has the maximum number of pending jobs"""
+
+
+class JobQueue:
+    """Background jobs persisted to SQLite and run by a bounded thread pool.
+
+    A job is a kind (naming a handler registered with register()), the
+    submitting user and JSON parameters. handler(params, progress) runs in
+    a worker thread, may call progress(**fields) to publish its progress,
+    and returns a JSON-serializable result. At most `workers` jobs run at
+    once, and at most `per_user` of them for one user. Callers poll get()
+    and compare the job's "version" to see whether it changed.
+    """
+
+    def __init__(self, path=JOB_DB_PATH, workers=JOB_WORKERS, per_user=JOB_WORKERS_PER_USER,
+                 max_pending_per_user=JOB_MAX_PENDING_PER_USER, retention=JOB_RETENTION_SECONDS):
+        self.path = path
+        self.workers = workers
+        self.per_user = per_user
+        self.max_pending_per_user = max_pending_per_user
+        self.retention = retention
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._executor = None
+        self._started = False
+        # Queued (job id, user id, kind) in submission order, and running job id -> user id
+        self._pending = []
+        self._running = {}
+        # Job id -> (progress dict, version bumped on every change) for unfinished jobs
+        self._progress = {}
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Autocommit; every access is serialized by self._lock
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(_SCHEMA)
+        return self._db
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="datalis-jobs")
+        return self._executor
+
+    def register(self, kind, handler):
+        """Set the function that runs jobs of a kind; register before start()."""
+        with self._lock:
+            self._handlers[kind] = handler
+            if self._started:
+                self._dispatch()
+
+    def start(self):
+        """Open the database, drop expired jobs and fail the unfinished ones (once per process)."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            db = self._connect()
+            db.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?", (time.time() - self.retention,))
+            # Sessions do not outlive the process, so nobody is left to collect unfinished jobs;
+            # running them again would only spend LLM calls
+            db.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Interrupted by a restart', finished = ? "
+                "WHERE status IN ('queued', 'running')", (time.time(),)
+            )
+
+    def submit(self, kind, user_id, params):
+        """Queue a job and return its id; raises JobLimitError if the user has too many pending."""
+        self.start()
+        with self._lock:
+            pending = sum(1 for _, user, _ in self._pending if user == user_id)
+            pending += sum(1 for user in self._running.values() if user == user_id)
+            if pending >= self.max_pending_per_user:
+                raise JobLimitError(f"You already have {pending} job(s) in progress. Please wait for them to finish.")
+
+            job_id = uuid.uuid4().hex
+            self._connect().execute(
+                "INSERT INTO jobs (id, kind, user_id, status, params, created) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, user_id, json.dumps(params), time.time())
+            )
+            self._pending.append((job_id, user_id, kind))
+            self._dispatch()
+        return job_id
+
+    def _dispatch(self):
+        """Start queued jobs while the global and per-user limits allow (lock held)."""
+        for job_id, user_id, kind in list(self._pending):
+            if len(self._running) >= self.workers:
+                break
+            if kind not in self._handlers:
+                continue
+            if sum(1 for user in self._running.values() if user == user_id) >= self.per_user:
+                continue
+            self._pending.remove((job_id, user_id, kind))
+            self._running[job_id] = user_id
+            self._bump(job_id)
+            db = self._connect()
+            db.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), job_id))
+            params = json.loads(db.execute("SELECT params FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+            self._get_executor().submit(self._run, job_id, self._handlers[kind], params)
+
+    def _run(self, job_id, handler, params):
+        def progress(**fields):
+            self._set_progress(job_id, fields)
+
+        try:
+            result = handler(params, progress)
+        except Exception as e:
+            print(f"Error running job {job_id}: {str(e)}")
+            self._finish(job_id, "failed", error=str(e))
+        else:
+            self._finish(job_id, "done", result=result)
+
+    def _bump(self, job_id, fields=None):
+        progress, version = self._progress.get(job_id, ({}, 0))
+        if fields:
+            progress = dict(progress, **fields)
+        self._progress[job_id] = (progress, version + 1)
+        return progress
+
+    def _set_progress(self, job_id, fields):
+        with self._lock:
+            progress = self._bump(job_id, fields)
+            self._connect().execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id))
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with self._lock:
+            self._running.pop(job_id, None)
+            # Progress of a finished job lives on only in the database
+            self._progress.pop(job_id, None)
+            try:
+                self._connect().execute(
+                    "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? WHERE id = ?",
+                    (status, json.dumps(result), error, time.time(), job_id)
+                )
+            except (TypeError, ValueError) as e:
+                # An unserializable result fails the job instead of leaving it running
+                self._connect().execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE id = ?",
+                    (f"Invalid job result: {str(e)}", time.time(), job_id)
+                )
+            self._dispatch()
+
+    def _get(self, job_id):
+        row = self._connect().execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(_COLUMNS, row))
+        for column in ("params", "progress", "result"):
+            job[column] = json.loads(job[column]) if job[column] is not None else None
+        if job["status"] == "queued":
+            job["queue_position"] = next(
+                (index for index, (pending_id, _, _) in enumerate(self._pending, start=1) if pending_id == job_id), None
+            )
+        # Finished jobs never change again, so they share one version no unfinished job has
+        job["version"] = -1 if job["finished"] is not None else self._progress.get(job_id, ({}, 0))[1]
+        return job
+
+    def get(self, job_id):
+        """Return a job as a dict (status, progress, result, error, ...), or None if unknown."""
+        with self._lock:
+            return self._get(job_id)
+
+    def stats(self):
+        """Return queue counters for monitoring."""
+        with self._lock:
+            return {"queued": len(self._pending), "running": len(self._running), "workers": self.workers}
+
+
+# Shared by every session; handlers are registered by the app that submits the jobs
+JOB_QUEUE = JobQueue()
+tracing.register_stats("jobs", JOB_QUEUE.stats)
@@ -0,0 +1,206 @@
+import os
+import re
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+import tracing
+from cache import LRUCache
+from session_store import SessionStore
+from tokens import iter_token_chunks
+from vector_index import RETRIEVAL_CHUNK_TOKENS, RETRIEVAL_TOP_K, INDEX_WAIT_SECONDS
+
+# Bump when tokenization or chunking changes
+KEYWORD_INDEX_VERSION = 1
+# BM25 term frequency saturation and length normalisation
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Keyword indexes kept in memory
+KEYWORD_INDEX_MAX_MB = int(os.environ.get("DATALIS_KEYWORD_INDEX_MAX_MB", 128))
+
+# Whole identifiers are kept as one term: GSTINs (27AAACB1234Q1Z5), sections
+# (194J, 43B), invoice and voucher numbers (INV-0001234), years (2024-25)
+TERM_PATTERN = re.compile(r"[a-z0-9]+(?:[./-][a-z0-9]+)*")
+PART_PATTERN = re.compile(r"[a-z]+|[0-9]+")
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were which with".split()
+)
+
+
+def tokenize(text):
+    """Split text into index terms.
+
+    Identifiers stay whole so an exact GSTIN, section or invoice number
+    matches exactly; compound ones also index their letter and digit runs
+    (inv-0001234 -> inv, 0001234) so partial references still match.
+    """
+    terms = []
+    for term in TERM_PATTERN.findall(text.lower()):
+        if term in STOP_WORDS:
+            continue
+        terms.append(term)
+        parts = PART_PATTERN.findall(term)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if len(part) > 1)
+    return terms
+
+
+class DocumentPostings:
+    """Inverted index of one document's chunks: term -> (chunk indices, term frequencies)"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.lengths = np.zeros(len(chunks), dtype=np.float32)
+        postings = {}
+        for index, chunk in enumerate(chunks):
+            counts = Counter(tokenize(chunk))
+            self.lengths[index] = sum(counts.values())
+            for term, count in counts.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(index)
+                postings[term][1].append(count)
+        self.postings = {
+            term: (np.array(indices, dtype=np.int32), np.array(counts, dtype=np.float32))
+            for term, (indices, counts) in postings.items()
+        }
+
+    def size(self):
+        """Approximate memory held, in bytes."""
+        return (
+            sum(len(chunk) for chunk in self.chunks) + self.lengths.nbytes +
+            sum(len(term) + indices.nbytes + counts.nbytes for term, (indices, counts) in self.postings.items())
+        )
+
+
+class KeywordIndex:
+    """Per-session BM25 retrieval over uploaded documents.
+
+    Documents are chunked exactly like the vector index (so results from
+    both can be fused by file and chunk), indexed once per content hash in
+    a background thread, and shared between sessions. Sessions hold only
+    document keys, so the LRU bounds memory; evicted postings are rebuilt
+    on the next search. Term statistics are computed over the searching
+    session's documents only.
+    """
+
+    def __init__(self, chunk_tokens=RETRIEVAL_CHUNK_TOKENS, max_bytes=KEYWORD_INDEX_MAX_MB * 1024 * 1024):
+        self.chunk_tokens = chunk_tokens
+        self._documents = LRUCache(max_entries=None, max_bytes=max_bytes, size_of=DocumentPostings.size)
+        # session id -> list of (file name, document key, load_text, future resolving to whether it is indexed)
+        self._sessions = SessionStore()
+        self._lock = threading.Lock()
+        self._executor = None
+        self.builds = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="datalis-keywords")
+            return self._executor
+
+    def _get_document(self, key, load_text):
+        """Return the postings of a document, building them if needed."""
+        try:
+            document = self._documents.get(key)
+            if document is not None:
+                return document
+            text = load_text()
+            if text is None:
+                return None
+            document = DocumentPostings(list(iter_token_chunks(text, self.chunk_tokens)))
+            with self._lock:
+                self.builds += 1
+            self._documents.set(key, document)
+            return document
+        except Exception as e:
+            print(f"Error building keyword index: {str(e)}")
+            return None
+
+    def _index_document(self, key, load_text):
+        # The future only reports success, so it does not keep the postings alive
+        return self._get_document(key, load_text) is not None
+
+    def add_document(self, session_id, file_name, content_key, load_text):
+        """Index a document for a session in the background (see VectorIndex.add_document)."""
+        key = f"{content_key}:bm25{KEYWORD_INDEX_VERSION}:{self.chunk_tokens}"
+        future = self._get_executor().submit(self._index_document, key, load_text)
+        self._sessions.setdefault(session_id, []).append((file_name, key, load_text, future))
+        return future
+
+    def drop_session(self, session_id):
+        """Forget which documents a session uploaded (the postings stay cached)."""
+        self._sessions.pop(session_id, None)
+
+    def search(self, session_id, query, k=RETRIEVAL_TOP_K):
+        """Return the session's k best BM25 matches for the query, best first,
+        as dicts with file, chunk (index), text and score."""
+        entries = self._sessions.get(session_id)
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not entries or not terms:
+            return []
+
+        wait([future for _, _, _, future in entries], timeout=INDEX_WAIT_SECONDS)
+        documents = []
+        for file_name, key, load_text, future in entries:
+            if not future.done() or not future.result():
+                continue
+            # Evicted postings are rebuilt from the (usually cached) text
+            document = self._get_document(key, load_text)
+            if document is not None and document.chunks:
+                documents.append((file_name, document))
+        if not documents:
+            return []
+
+        # Corpus statistics over this session's chunks
+        chunk_count = sum(len(document.chunks) for _, document in documents)
+        average_length = sum(float(document.lengths.sum()) for _, document in documents) / chunk_count or 1.0
+        idf = {}
+        for term in terms:
+            frequency = sum(len(document.postings[term][0]) for _, document in documents if term in document.postings)
+            if frequency:
+                idf[term] = np.log(1 + (chunk_count - frequency + 0.5) / (frequency + 0.5))
+        if not idf:
+            return []
+
+        candidates = []
+        for file_name, document in documents:
+            scores = np.zeros(len(document.chunks), dtype=np.float32)
+            norms = BM25_K1 * (1 - BM25_B + BM25_B * document.lengths / average_length)
+            for term, weight in idf.items():
+                if term not in document.postings:
+                    continue
+                indices, counts = document.postings[term]
+                scores[indices] += weight * counts * (BM25_K1 + 1) / (counts + norms[indices])
+            matched = np.flatnonzero(scores)
+            if not len(matched):
+                continue
+            top = matched[np.argsort(-scores[matched])[:k]]
+            candidates.extend(
+                {"file": file_name, "chunk": int(index), "text": document.chunks[index], "score": float(scores[index])}
+                for index in top
+            )
+        candidates.sort(key=lambda candidate: candidate["score"], reverse=True)
+        return candidates[:k]
+
+    def stats(self):
+        """Return index counters for monitoring."""
+        with self._lock:
+            builds = self.builds
+        return {"sessions": len(self._sessions), "builds": builds, "memory": self._documents.stats()}
+
+
+# Shared by every agent and session
+KEYWORD_INDEX = KeywordIndex()
+tracing.register_stats("keyword_index", KEYWORD_INDEX.stats)
+
+
+def fuse_results(result_lists, k=RETRIEVAL_TOP_K, rank_constant=60):
+    """Merge ranked result lists (e.g. keyword and vector search) with
+    reciprocal rank fusion; results are matched by file and chunk."""
+    fused = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, start=1):
+            key = (result["file"], result["chunk"])
+            entry = fused.setdefault(key, dict(result, score=0.0))
+            entry["score"] += 1.0 / (rank_constant + rank)
+    return sorted(fused.values(), key=lambda result: result["score"], reverse=True)[:k]
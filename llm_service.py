@@ -1,52 +1,376 @@
 import os
-from groq import Groq
+import time
+import asyncio
+import contextlib
+import threading
+import weakref
+from collections import deque
 from dotenv import load_dotenv
+import tracing
+from cache import TieredCache, hash_text
+from rate_limiter import RATE_LIMITER, estimate_tokens
+from tokens import count_tokens
 
 # Load environment variables
 load_dotenv()
 
+# Connection pool and concurrency limits shared by every agent in the process
+LLM_MAX_CONCURRENCY = int(os.environ.get("DATALIS_LLM_MAX_CONCURRENCY", 8))
+LLM_MAX_CONNECTIONS = int(os.environ.get("DATALIS_LLM_MAX_CONNECTIONS", 20))
+LLM_KEEPALIVE_SECONDS = float(os.environ.get("DATALIS_LLM_KEEPALIVE_SECONDS", 60))
+LLM_TIMEOUT_SECONDS = float(os.environ.get("DATALIS_LLM_TIMEOUT_SECONDS", 120))
+# "groq" for the real API, "fake" for the offline stand-in in fake_llm.py
+LLM_BACKEND = os.environ.get("DATALIS_LLM_BACKEND", "groq")
+
+
+def _grant(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class RequestSlots:
+    """Cap on concurrent holders (in-flight LLM requests, or 1 for a lock), usable from threads and coroutines.
+
+    Waiters queue in arrival order whether they are threads or coroutines,
+    and a released slot is handed straight to the longest waiter, so
+    neither kind can starve the other and coroutines wait without polling.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._available = limit
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def in_use(self):
+        """Whether any slot is held or waited for."""
+        with self._lock:
+            return self._available < self.limit or bool(self._waiters)
+
+    def _acquire_or_queue(self, waiter):
+        """Take a free slot (True), or queue the waiter to be handed one (False)."""
+        with self._lock:
+            if self._available > 0 and not self._waiters:
+                self._available -= 1
+                return True
+            self._waiters.append(waiter)
+            return False
+
+    def _release(self):
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                try:
+                    waiter.get_loop().call_soon_threadsafe(_grant, waiter)
+                    return
+                except RuntimeError:
+                    # The waiter's event loop is closed; pass the slot on
+                    continue
+            self._available += 1
+
+    def __enter__(self):
+        waiter = threading.Event()
+        if not self._acquire_or_queue(waiter):
+            waiter.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._release()
+
+    async def __aenter__(self):
+        waiter = asyncio.get_running_loop().create_future()
+        if not self._acquire_or_queue(waiter):
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._lock:
+                    queued = waiter in self._waiters
+                    if queued:
+                        self._waiters.remove(waiter)
+                if not queued:
+                    # The slot was handed over just as the wait was cancelled
+                    self._release()
+                raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._release()
+
+
+request_slots = RequestSlots(LLM_MAX_CONCURRENCY)
+
+# Responses to identical requests, shared by every agent (and, with a cache
+# directory, by every process)
+_response_cache_ttl = os.environ.get("DATALIS_RESPONSE_CACHE_TTL_SECONDS")
+RESPONSE_CACHE = TieredCache(
+    max_entries=int(os.environ.get("DATALIS_RESPONSE_CACHE_ENTRIES", 512)),
+    max_bytes=int(os.environ.get("DATALIS_RESPONSE_CACHE_MB", 64)) * 1024 * 1024,
+    directory=os.environ.get("DATALIS_RESPONSE_CACHE_DIR") or None,
+    ttl=float(_response_cache_ttl) if _response_cache_ttl else None
+)
+tracing.register_stats("response_cache", RESPONSE_CACHE.stats)
+tracing.register_stats("llm_rate_limit", RATE_LIMITER.stats)
+
+_client_lock = threading.Lock()
+_shared_client = None
+# httpx async clients are bound to the event loop that created them
+_shared_async_clients = weakref.WeakKeyDictionary()
+_fake_backend = None
+
+
+def use_fake_backend(backend=None):
+    """Route every LLM call in the process to an offline FakeLLMBackend.
+
+    Passing None builds one from the DATALIS_FAKE_LLM_* environment variables.
+    Returns the backend so callers can inspect or tune it.
+    """
+    global _shared_client, _fake_backend
+    from fake_llm import FakeLLMBackend
+    with _client_lock:
+        _fake_backend = backend or FakeLLMBackend.from_env()
+        _shared_client = None
+        _shared_async_clients.clear()
+    return _fake_backend
+
+
+def _using_fake_backend():
+    return _fake_backend is not None or LLM_BACKEND == "fake"
+
+
+def _connection_limits():
+    import httpx
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_SECONDS
+    )
+
+
+def get_shared_client(api_key):
+    """Return the process-wide Groq client with a keep-alive connection pool."""
+    global _shared_client, _fake_backend
+    with _client_lock:
+        if _shared_client is None and _using_fake_backend():
+            from fake_llm import FakeGroq, FakeLLMBackend
+            _fake_backend = _fake_backend or FakeLLMBackend.from_env()
+            _shared_client = FakeGroq(_fake_backend)
+        elif _shared_client is None:
+            # The SDK is imported with the first real client, not at startup
+            import httpx
+            from groq import Groq
+            _shared_client = Groq(
+                api_key=api_key,
+                http_client=httpx.Client(limits=_connection_limits(), timeout=LLM_TIMEOUT_SECONDS)
+            )
+        return _shared_client
+
+
+def get_shared_async_client(api_key):
+    """Return the async Groq client for the running event loop."""
+    global _fake_backend
+    loop = asyncio.get_running_loop()
+    with _client_lock:
+        client = _shared_async_clients.get(loop)
+        if client is None and _using_fake_backend():
+            from fake_llm import AsyncFakeGroq, FakeLLMBackend
+            _fake_backend = _fake_backend or FakeLLMBackend.from_env()
+            client = AsyncFakeGroq(_fake_backend)
+            _shared_async_clients[loop] = client
+        elif client is None:
+            import httpx
+            from groq import AsyncGroq
+            client = AsyncGroq(
+                api_key=api_key,
+                http_client=httpx.AsyncClient(limits=_connection_limits(), timeout=LLM_TIMEOUT_SECONDS)
+            )
+            _shared_async_clients[loop] = client
+        return client
+
+
 class LLMService:
     """Service for interacting with LLM APIs"""
-    
+
     def __init__(self):
         self.api_key = os.environ.get("GROQ_API_KEY")
-        if not self.api_key:
+        if not self.api_key and not _using_fake_backend():
             raise EnvironmentError("GROQ_API_KEY environment variable not set")
-        
-        self.client = Groq(api_key=self.api_key)
-        self.response_cache = {}  # Simple cache for performance
-    
+
+        self.response_cache = RESPONSE_CACHE
+
+    @property
+    def client(self):
+        """Process-wide client; agents share it instead of opening their own connections."""
+        return get_shared_client(self.api_key)
+
+    @property
+    def async_client(self):
+        """Async client bound to the current event loop."""
+        return get_shared_async_client(self.api_key)
+
+    @staticmethod
+    def response_cache_key(prompt, system_message, model, temperature, max_tokens):
+        """Hash every request parameter that affects the response."""
+        return "response:" + hash_text(model, temperature, max_tokens, system_message, prompt)
+
+    @staticmethod
+    def response_cache_stats():
+        """Return hit/miss/eviction counters for the response cache."""
+        return RESPONSE_CACHE.stats()
+
+    @staticmethod
+    def rate_limit_stats():
+        """Return throttling and retry counters for LLM calls."""
+        return RATE_LIMITER.stats()
+
+    @staticmethod
+    def _usage(completion, name):
+        return getattr(getattr(completion, "usage", None), name, None)
+
+    def _create_completion(self, hold_slot=True, **params):
+        """Send a request within the rate limits, retrying rate-limited and
+        transient failures with backoff; raises once retries run out.
+
+        Callers that already hold a request slot pass hold_slot=False."""
+        reserved = estimate_tokens(params["messages"], params.get("max_tokens"))
+        attempt = 0
+        with tracing.span("llm.request", model=params.get("model"), stream=params.get("stream", False)) as span:
+            while True:
+                RATE_LIMITER.acquire(reserved)
+                try:
+                    with request_slots if hold_slot else contextlib.nullcontext():
+                        completion = self.client.chat.completions.create(**params)
+                except Exception as e:
+                    RATE_LIMITER.settle(reserved, 0)
+                    delay = RATE_LIMITER.retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    span.set(retries=attempt)
+                    # Back off without holding a request slot
+                    time.sleep(delay)
+                    continue
+                RATE_LIMITER.settle(reserved, self._usage(completion, "total_tokens"))
+                span.set(
+                    prompt_tokens=self._usage(completion, "prompt_tokens"),
+                    completion_tokens=self._usage(completion, "completion_tokens")
+                )
+                return completion
+
+    async def _acreate_completion(self, hold_slot=True, **params):
+        """Async variant of _create_completion."""
+        reserved = estimate_tokens(params["messages"], params.get("max_tokens"))
+        attempt = 0
+        with tracing.span("llm.request", model=params.get("model"), stream=params.get("stream", False)) as span:
+            while True:
+                await RATE_LIMITER.aacquire(reserved)
+                try:
+                    async with request_slots if hold_slot else contextlib.nullcontext():
+                        completion = await self.async_client.chat.completions.create(**params)
+                except Exception as e:
+                    RATE_LIMITER.settle(reserved, 0)
+                    delay = RATE_LIMITER.retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    span.set(retries=attempt)
+                    await asyncio.sleep(delay)
+                    continue
+                RATE_LIMITER.settle(reserved, self._usage(completion, "total_tokens"))
+                span.set(
+                    prompt_tokens=self._usage(completion, "prompt_tokens"),
+                    completion_tokens=self._usage(completion, "completion_tokens")
+                )
+                return completion
+
+    @staticmethod
+    def _settle_stream(messages, max_tokens, parts, span):
+        # Streamed chunks carry no usage, so count what was received
+        prompt_tokens = estimate_tokens(messages, 0)
+        completion_tokens = count_tokens.__wrapped__("".join(parts))
+        RATE_LIMITER.settle(estimate_tokens(messages, max_tokens), prompt_tokens + completion_tokens)
+        span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
     def get_response(self, prompt, system_message, model="llama3-70b-8192", temperature=0.7, max_tokens=2048):
         """Get a response from the LLM with caching for performance."""
-        # Create a unique key for caching based on parameters
-        cache_key = f"{prompt[:100]}_{model}_{system_message}"
-            
-        if cache_key in self.response_cache:
-            return self.response_cache[cache_key]
-            
+        # The key covers the full request, so different documents never collide
+        cache_key = self.response_cache_key(prompt, system_message, model, temperature, max_tokens)
+
+        with tracing.span("llm.get_response", model=model) as span:
+            cached = self.response_cache.get(cache_key)
+            span.set(cache_hit=cached is not None)
+            if cached is not None:
+                return cached
+
+            try:
+                chat_completion = self._create_completion(
+                    messages=[
+                        {"role": "system", "content": system_message},
+                        {"role": "user", "content": prompt}
+                    ],
+                    model=model,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    top_p=1,
+                )
+                response = chat_completion.choices[0].message.content
+                self.response_cache.set(cache_key, response)  # Store the response in cache
+                return response
+            except Exception as e:
+                error_msg = f"Error calling LLM API: {str(e)}"
+                print(error_msg)
+                return error_msg
+
+    async def aget_response(self, prompt, system_message, model="llama3-70b-8192", temperature=0.7, max_tokens=2048):
+        """Async variant of get_response."""
+        cache_key = self.response_cache_key(prompt, system_message, model, temperature, max_tokens)
+
+        with tracing.span("llm.get_response", model=model) as span:
+            cached = self.response_cache.get(cache_key)
+            span.set(cache_hit=cached is not None)
+            if cached is not None:
+                return cached
+
+            try:
+                chat_completion = await self._acreate_completion(
+                    messages=[
+                        {"role": "system", "content": system_message},
+                        {"role": "user", "content": prompt}
+                    ],
+                    model=model,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    top_p=1,
+                )
+                response = chat_completion.choices[0].message.content
+                self.response_cache.set(cache_key, response)
+                return response
+            except Exception as e:
+                error_msg = f"Error calling LLM API: {str(e)}"
+                print(error_msg)
+                return error_msg
+
+    def get_chat_response(self, messages, model="llama3-8b-8192", temperature=0.7, max_tokens=2048):
+        """Get a response for a chat conversation."""
         try:
-            chat_completion = self.client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": prompt}
-                ],
+            chat_completion = self._create_completion(
+                messages=messages,
                 model=model,
                 temperature=temperature,
                 max_tokens=max_tokens,
-                top_p=1,
             )
-            response = chat_completion.choices[0].message.content
-            self.response_cache[cache_key] = response  # Store the response in cache
-            return response
+            return chat_completion.choices[0].message.content
         except Exception as e:
             error_msg = f"Error calling LLM API: {str(e)}"
             print(error_msg)
             return error_msg
-    
-    def get_chat_response(self, messages, model="llama3-8b-8192", temperature=0.7, max_tokens=2048):
-        """Get a response for a chat conversation."""
+
+    async def aget_chat_response(self, messages, model="llama3-8b-8192", temperature=0.7, max_tokens=2048):
+        """Async variant of get_chat_response."""
         try:
-            chat_completion = self.client.chat.completions.create(
+            chat_completion = await self._acreate_completion(
                 messages=messages,
                 model=model,
                 temperature=temperature,
@@ -57,3 +381,70 @@ class LLMService:
             error_msg = f"Error calling LLM API: {str(e)}"
             print(error_msg)
             return error_msg
+
+    def stream_chat_response(self, messages, model="llama3-8b-8192", temperature=0.7, max_tokens=2048):
+        """Yield the response for a chat conversation as text deltas arrive."""
+        started = time.perf_counter()
+        with tracing.span("llm.stream", model=model) as span:
+            stream = None
+            parts = []
+            try:
+                # One slot covers opening the stream and reading it to the end
+                with request_slots:
+                    # Failures are retried only until the stream opens, never after text was sent
+                    stream = self._create_completion(
+                        hold_slot=False,
+                        messages=messages,
+                        model=model,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        stream=True,
+                    )
+                    for chunk in stream:
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            if not parts:
+                                span.set(first_token_ms=round((time.perf_counter() - started) * 1000, 1))
+                            parts.append(delta)
+                            yield delta
+            except Exception as e:
+                error_msg = f"Error calling LLM API: {str(e)}"
+                print(error_msg)
+                yield error_msg
+            finally:
+                # A stream that opened settles its reservation even if it broke off
+                if stream is not None:
+                    self._settle_stream(messages, max_tokens, parts, span)
+
+    async def astream_chat_response(self, messages, model="llama3-8b-8192", temperature=0.7, max_tokens=2048):
+        """Async variant of stream_chat_response."""
+        started = time.perf_counter()
+        with tracing.span("llm.stream", model=model) as span:
+            stream = None
+            parts = []
+            try:
+                # One slot covers opening the stream and reading it to the end
+                async with request_slots:
+                    stream = await self._acreate_completion(
+                        hold_slot=False,
+                        messages=messages,
+                        model=model,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        stream=True,
+                    )
+                    async for chunk in stream:
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            if not parts:
+                                span.set(first_token_ms=round((time.perf_counter() - started) * 1000, 1))
+                            parts.append(delta)
+                            yield delta
+            except Exception as e:
+                error_msg = f"Error calling LLM API: {str(e)}"
+                print(error_msg)
+                yield error_msg
+            finally:
+                # A stream that opened settles its reservation even if it broke off
+                if stream is not None:
+                    self._settle_stream(messages, max_tokens, parts, span)
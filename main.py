@@ -1,29 +1,57 @@
 import os
 import gradio as gr
 import time
+import asyncio
 import uuid
 from file_handler import FileHandler
 from agent_factory import AgentFactory
 from company_info import create_company_info_ui
+from materiality import MaterialityThresholds
+from analysis_pipeline import analyze_files
+from session_store import SessionStore, remove_uploaded_files, uploaded_files_size
+from vector_index import VECTOR_INDEX
+from keyword_index import KEYWORD_INDEX
+import tracing
+from job_queue import JOB_QUEUE, JobLimitError
+from auditor_agent import REPORT_SECTIONS
 
-# Store uploaded files and session data
-uploaded_files = {}
-session_data = {}
+def end_session(session_id, data):
+    """Release everything held for an expired session"""
+    uploaded_files.pop(session_id)
+    VECTOR_INDEX.drop_session(session_id)
+    KEYWORD_INDEX.drop_session(session_id)
+    for agent in AgentFactory.active_agents():
+        agent.clear_history(session_id)
+
+# Store uploaded files and session data; sessions expire when idle and their
+# uploaded temp files are deleted
+uploaded_files = SessionStore(ttl=None, max_sessions=None, on_evict=remove_uploaded_files, size_of=uploaded_files_size)
+session_data = SessionStore(on_evict=end_session)
 available_agents = ["Dabby Consultant", "Auditor Agent", "Tax Agent"]
 
+def session_gauges():
+    """Return gauges for live sessions and the memory/disk they hold"""
+    gauges = session_data.gauges()
+    gauges["uploaded_bytes_held"] = uploaded_files.gauges()["bytes_held"]
+    return gauges
+
+tracing.register_stats("sessions", session_gauges)
+
 def get_agent(session_id):
     """Get the current agent for a session"""
     if session_id not in session_data:
         session_data[session_id] = {
             "agent_name": "Dabby Consultant",
-            "agent": AgentFactory.get_agent("Dabby Consultant"),
             "company_info": None
         }
-    return session_data[session_id]["agent"]
+    # Agents are shared; only the session's choice of agent is stored
+    return AgentFactory.get_agent(session_data[session_id]["agent_name"])
 
 def upload_file(files, chatbot, session_id):
-    """Handle file uploads and automatically analyze them"""
+    """Handle file uploads and automatically analyze the new ones"""
     file_list = FileHandler.handle_uploaded_files(files, session_id, uploaded_files)
+    # Auditor sessions will want a report, whose framework can be detected while the files are analyzed
+    prefetch_audit_framework(session_id)
     
     # Create a message to show files were uploaded
     if files and len(files) > 0:
@@ -34,30 +62,30 @@ def upload_file(files, chatbot, session_id):
         updated_chatbot = chatbot.copy() if chatbot else []
         updated_chatbot.append(("System", message))
         
-        # Automatically analyze all uploaded files
+        # Automatically analyze the files not yet analyzed in this session
         agent = get_agent(session_id)
+        new_files = [file for file in uploaded_files[session_id] if not file.get("analyzed")]
+        
+        updated_chatbot.append(("System", f"Automatically analyzing {len(new_files)} new file(s)..."))
         
-        updated_chatbot.append(("System", "Automatically analyzing all uploaded files..."))
+        # Add a placeholder message for each file analysis
+        rows = {}
+        for file in new_files:
+            updated_chatbot.append((f"Analyzing: {file['name']}", "Processing..."))
+            rows[id(file)] = len(updated_chatbot) - 1
+        yield updated_chatbot, gr.update(value=file_list)
         
+        # Files are extracted in parallel and analyzed concurrently; each
+        # result replaces its placeholder as soon as it completes
         analysis_results = []
-        for file in uploaded_files[session_id]:
-            try:
-                file_name = file["name"]
-                file_path = file["path"]
-                
-                # Add a message for each file analysis
-                updated_chatbot.append((f"Analyzing: {file_name}", "Processing..."))
-                
-                # Get response from agent
-                response = agent.analyze_file(file_name, file_path, session_id)
-                
-                # Update the last message with the actual response
-                updated_chatbot[-1] = (f"Analysis of {file_name}", response)
-                
-                analysis_results.append({"file": file_name, "analysis": response})
-            except Exception as e:
-                # If there's an error, update the message accordingly
-                updated_chatbot.append((f"Error analyzing {file_name}", f"Error: {str(e)}"))
+        for file, response, succeeded in analyze_files(agent, new_files, session_id):
+            if succeeded:
+                file["analyzed"] = True
+                updated_chatbot[rows[id(file)]] = (f"Analysis of {file['name']}", response)
+                analysis_results.append({"file": file["name"], "analysis": response})
+            else:
+                updated_chatbot[rows[id(file)]] = (f"Error analyzing {file['name']}", response)
+            yield updated_chatbot, gr.update(value=file_list)
         
         # Add a summary of all files if there are multiple
         if len(analysis_results) > 1:
@@ -66,10 +94,10 @@ def upload_file(files, chatbot, session_id):
             combined_analysis = agent.chat(combined_analysis_prompt, session_id)
             
             updated_chatbot.append(("Combined Analysis Summary", combined_analysis))
-        
-        return updated_chatbot, gr.update(value=file_list)
+            yield updated_chatbot, gr.update(value=file_list)
+        return
     
-    return chatbot, gr.update(value=file_list)
+    yield chatbot, gr.update(value=file_list)
 
 
 def analyze_file(file_name, chatbot, session_id):
@@ -117,10 +145,11 @@ def analyze_file(file_name, chatbot, session_id):
     
     return updated_chatbot
 
-def chat(message, chatbot, session_id):
+async def chat(message, chatbot, session_id):
     """Handle chat interactions"""
     if not message.strip():
-        return chatbot
+        yield chatbot
+        return
     
     # Create a copy of the chatbot
     updated_chatbot = chatbot.copy() if chatbot else []
@@ -133,10 +162,12 @@ def chat(message, chatbot, session_id):
     agent = get_agent(session_id)
     
     try:
-        response = agent.chat(message, session_id)
-        
-        # Update chatbot
-        updated_chatbot[-1] = (message, response)
+        # Stream the answer into the chatbot as tokens arrive
+        response = ""
+        async for delta in agent.astream_chat(message, session_id):
+            response += delta
+            updated_chatbot[-1] = (message, response)
+            yield updated_chatbot
     except Exception as e:
         # If there's an error, update the message accordingly
         updated_chatbot[-1] = (message, f"Error: {str(e)}")
@@ -149,7 +180,7 @@ def change_agent(agent_name, session_id):
         session_data[session_id] = {}
     
     session_data[session_id]["agent_name"] = agent_name
-    session_data[session_id]["agent"] = AgentFactory.get_agent(agent_name)
+    prefetch_audit_framework(session_id)
     
     return f"Agent switched to {agent_name}"
 
@@ -163,33 +194,139 @@ def save_company_info(company_info, session_id):
     """Save company information to session data"""
     if session_id not in session_data:
         session_data[session_id] = {
-            "agent_name": "Dabby Consultant",
-            "agent": AgentFactory.get_agent("Dabby Consultant")
+            "agent_name": "Dabby Consultant"
         }
     
     session_data[session_id]["company_info"] = company_info
     return "Company information saved successfully!"
 
-def generate_audit_report(format_selection, chatbot, session_id):
-    """Generate an audit report in the selected format"""
+# Report formats offered in the audit tools, and the audit type each one produces
+FORMAT_TO_AUDIT_TYPE = {
+    "CARO Format": "Companies (Auditor's Report) Order",
+    "SA 230 Format": "Standard on Auditing 230",
+    "IndAS Format": "Indian Accounting Standards",
+    "GAAP Format": "Generally Accepted Accounting Principles"
+}
+# Job queue kind for audit reports
+REPORT_JOB = "audit_report"
+# How often the UI checks a report job for progress
+REPORT_POLL_SECONDS = 0.5
+
+def report_audit_type(format_selection):
+    """Audit type of a report format (a general financial statement audit if none is selected)"""
+    return FORMAT_TO_AUDIT_TYPE.get(format_selection, "Financial Statement")
+
+def read_report_documents(file_paths, company_info):
+    """Return (document excerpts, material items text) that an audit report is written from"""
+    # Apply the materiality thresholds from the company information, if any were entered
+    thresholds = MaterialityThresholds.from_company_info(company_info)
+    
+    # Get document excerpts; the report prompts only use the start of each document.
+    # With materiality thresholds, ledgers contribute their material items instead of raw rows.
+    document_texts = []
+    material_items = []
+    for file_path in file_paths:
+        if thresholds and FileHandler.is_tabular_file(file_path):
+            material_items.append(FileHandler.extract_material_items(file_path, thresholds))
+            continue
+        text = FileHandler.read_file_prefix(file_path, 3000)
+        document_texts.append(text)
+    return document_texts, "\n\n".join(material_items)
+
+def prefetch_audit_framework(session_id, format_selection=None):
+    """Start detecting the audit framework of a session's files in the background,
+    so it is already known when the report is generated"""
+    if session_id not in session_data or session_data[session_id].get("agent_name") != "Auditor Agent":
+        return
+    if format_selection is not None:
+        session_data[session_id]["report_format"] = format_selection
+    if not uploaded_files.get(session_id):
+        return
+    
+    file_paths = [file["path"] for file in uploaded_files[session_id]]
+    company_info = session_data[session_id].get("company_info", None)
+    
+    def load_documents():
+        document_texts, material_items = read_report_documents(file_paths, company_info)
+        return document_texts + ([material_items] if material_items else [])
+    
+    agent = AgentFactory.get_agent("Auditor Agent")
+    agent.prefetch_audit_framework(
+        load_documents, report_audit_type(session_data[session_id].get("report_format"))
+    )
+
+def run_report_job(params, progress):
+    """Generate an audit report in a background worker (the REPORT_JOB handler).
+
+    params holds the files, audit type and company info captured when the
+    report was requested; returns the DOCX path and section timings.
+    """
+    agent = AgentFactory.get_agent("Auditor Agent")
+    company_info = params["company_info"]
+    audit_type = params["audit_type"]
+    
+    progress(step="Reading documents")
+    document_texts, material_items = read_report_documents(params["files"], company_info)
+    
+    # Determine appropriate framework (usually already prefetched)
+    progress(step="Identifying the audit framework")
+    framework = agent.determine_audit_framework(
+        document_texts + ([material_items] if material_items else []), audit_type
+    )
+    
+    # Generate the report, publishing each section as it is finished
+    sections_done = []
+    progress(step="Writing sections", sections_done=sections_done, sections_total=len(REPORT_SECTIONS))
+    
+    def on_section(key, text):
+        sections_done.append(key)
+        progress(sections_done=list(sections_done))
+    
+    timings = {}
+    report_path = agent.generate_audit_report_docx(
+        audit_type, document_texts, framework, company_info, timings, material_items, on_section
+    )
+    return {"path": report_path, "timings": timings}
+
+JOB_QUEUE.register(REPORT_JOB, run_report_job)
+
+def report_progress_message(format_selection, job):
+    """Chat message describing where a report job is"""
+    if job["status"] == "queued":
+        position = job.get("queue_position")
+        waiting = f" (position {position} in the queue)" if position else ""
+        return f"{format_selection} audit report queued{waiting}..."
+    progress = job["progress"] or {}
+    message = f"Generating {format_selection} audit report... {progress.get('step', 'Starting')}"
+    if "sections_total" in progress:
+        headings = dict((key, heading) for key, heading, _ in REPORT_SECTIONS)
+        done = progress.get("sections_done", [])
+        message += f" ({len(done)}/{progress['sections_total']} sections done"
+        if done:
+            message += ": " + ", ".join(headings.get(key, key) for key in done)
+        message += ")"
+    return message
+
+async def generate_audit_report(format_selection, chatbot, session_id):
+    """Queue an audit report in the selected format and show its progress until it is ready"""
     if session_id not in session_data:
         updated_chatbot = chatbot.copy() if chatbot else []
         updated_chatbot.append(("System", "Session data not found. Please try again."))
-        return updated_chatbot, None
+        yield updated_chatbot, None
+        return
     
     if session_id not in uploaded_files or not uploaded_files[session_id]:
         updated_chatbot = chatbot.copy() if chatbot else []
         updated_chatbot.append(("System", "No files uploaded. Please upload files first."))
-        return updated_chatbot, None
-    
-    # Get the current agent
-    agent = get_agent(session_id)
+        yield updated_chatbot, None
+        return
     
     # Check if it's an auditor agent
     if session_data[session_id]["agent_name"] != "Auditor Agent":
         updated_chatbot = chatbot.copy() if chatbot else []
         updated_chatbot.append(("System", "Please switch to the Auditor Agent to generate audit reports."))
-        return updated_chatbot, None
+        yield updated_chatbot, None
+        return
     
     # Create a copy of the chatbot
     updated_chatbot = chatbot.copy() if chatbot else []
@@ -197,45 +334,76 @@ def generate_audit_report(format_selection, chatbot, session_id):
     # Add a message indicating report generation is in progress
     updated_chatbot.append(("System", f"Generating {format_selection} audit report..."))
     
+    # The report is generated by a background worker so this request does not hold a server thread
     try:
-        # Get document texts
-        document_texts = []
-        for file in uploaded_files[session_id]:
-            text = FileHandler.process_file(file["path"])
-            document_texts.append(text)
-        
-        # Map format selection to audit type
-        format_to_audit_type = {
-            "CARO Format": "Companies (Auditor's Report) Order",
-            "SA 230 Format": "Standard on Auditing 230",
-            "IndAS Format": "Indian Accounting Standards",
-            "GAAP Format": "Generally Accepted Accounting Principles"
-        }
-        
-        audit_type = format_to_audit_type.get(format_selection, "Financial Statement")
-        
-        # Determine appropriate framework
-        framework = agent.determine_audit_framework(document_texts, audit_type)
-        
-        # Get company info
-        company_info = session_data[session_id].get("company_info", None)
-        
-        # Generate the report
-        report_path = agent.generate_audit_report_docx(audit_type, document_texts, framework, company_info)
+        job_id = JOB_QUEUE.submit(REPORT_JOB, session_id, {
+            "format": format_selection,
+            "audit_type": report_audit_type(format_selection),
+            "files": [file["path"] for file in uploaded_files[session_id]],
+            "company_info": session_data[session_id].get("company_info", None),
+        })
+    except JobLimitError as e:
+        updated_chatbot[-1] = ("System", str(e))
+        yield updated_chatbot, None
+        return
+    yield updated_chatbot, None
+    
+    # Show each step and section as the worker finishes it; polling from the
+    # event loop keeps no server thread waiting for the report
+    version = None
+    while True:
+        await asyncio.sleep(REPORT_POLL_SECONDS)
+        job = JOB_QUEUE.get(job_id)
+        if job is None:
+            updated_chatbot[-1] = ("System", "Error generating report: the report job was lost.")
+            yield updated_chatbot, None
+            return
+        if job["version"] == version:
+            continue
+        version = job["version"]
         
-        # Update the last message with success
-        updated_chatbot[-1] = ("System", f"✅ {format_selection} audit report generated successfully!")
+        if job["status"] == "done":
+            # Update the last message with success and where the time went
+            timing_summary = ", ".join(f"{key} {seconds:.1f}s" for key, seconds in job["result"]["timings"].items())
+            updated_chatbot[-1] = (
+                "System", f"✅ {format_selection} audit report generated successfully! ({timing_summary})"
+            )
+            yield updated_chatbot, job["result"]["path"]
+            return
+        if job["status"] == "failed":
+            updated_chatbot[-1] = ("System", f"Error generating report: {job['error']}")
+            yield updated_chatbot, None
+            return
         
-        return updated_chatbot, report_path
-    except Exception as e:
-        # If there's an error, update the message accordingly
-        updated_chatbot[-1] = ("System", f"Error generating report: {str(e)}")
-        return updated_chatbot, None
+        updated_chatbot[-1] = ("System", report_progress_message(format_selection, job))
+        yield updated_chatbot, None
+
+def suggest_audit_questions(chatbot, session_id):
+    """Suggest questions an auditor should ask about the session's uploaded documents"""
+    updated_chatbot = chatbot.copy() if chatbot else []
+    if session_id not in uploaded_files or not uploaded_files[session_id]:
+        updated_chatbot.append(("System", "No files uploaded. Please upload files first."))
+        return updated_chatbot
+    
+    # The start of each document, plus risk-area passages found anywhere in them by keyword search
+    text = "\n\n".join(
+        FileHandler.read_file_prefix(file["path"], 4000 // len(uploaded_files[session_id]))
+        for file in uploaded_files[session_id]
+    )
+    agent = AgentFactory.get_agent("Auditor Agent")
+    updated_chatbot.append(("Suggested audit questions", agent.generate_suggested_questions(text, session_id)))
+    return updated_chatbot
 
 def create_ui():
     """Create the Gradio UI"""
+    # Serves /metrics when DATALIS_METRICS_PORT is set
+    tracing.start_metrics_server()
+    # Clears out report jobs left unfinished by a previous run
+    JOB_QUEUE.start()
     with gr.Blocks(title="DABBY", theme=gr.themes.Soft()) as app:
-        session_id = gr.State(value=str(uuid.uuid4()))
+        # Each browser session gets its own id when the page loads
+        session_id = gr.State()
+        app.load(fn=lambda: str(uuid.uuid4()), outputs=[session_id])
         
         with gr.Tabs() as tabs:
             with gr.TabItem("Chat"):
@@ -265,6 +433,7 @@ def create_ui():
                                 value=None
                             )
                             generate_report_button = gr.Button("Generate Audit Report")
+                            suggest_questions_button = gr.Button("Suggest Audit Questions")
                     with gr.Column(scale=3):
                         chatbot = gr.Chatbot(height=600)
                         with gr.Row():
@@ -347,6 +516,18 @@ def create_ui():
                 outputs=[gr.Textbox(visible=False)]
             )
         
+        # Detect the framework for the chosen format before the report is requested
+        format_dropdown.change(
+            fn=lambda format_selection, session_id: prefetch_audit_framework(session_id, format_selection),
+            inputs=[format_dropdown, session_id]
+        )
+        
+        suggest_questions_button.click(
+            fn=suggest_audit_questions,
+            inputs=[chatbot, session_id],
+            outputs=[chatbot]
+        )
+        
         # Handle audit report generation
         generate_report_button.click(
             fn=generate_audit_report,
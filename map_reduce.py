@@ -0,0 +1,200 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import tracing
+from tokens import count_tokens, iter_token_chunks, truncate_to_tokens
+
+# Document tokens sent in each map call
+MAP_REDUCE_CHUNK_TOKENS = int(os.environ.get("DATALIS_MAP_REDUCE_CHUNK_TOKENS", 3000))
+# Map calls sent to the LLM at the same time
+MAP_REDUCE_WORKERS = int(os.environ.get("DATALIS_MAP_REDUCE_WORKERS", 4))
+# Cap on the tokens (prompts and responses) one map-reduce request may spend
+MAP_REDUCE_MAX_TOKENS = int(os.environ.get("DATALIS_MAP_REDUCE_MAX_TOKENS", 100000))
+# Response length of each partial (map or intermediate reduce) result
+PARTIAL_RESPONSE_TOKENS = 512
+# Response length of the final answer
+FINAL_RESPONSE_TOKENS = 2048
+
+
+def is_failed_analysis(response):
+    """Check whether an analysis result is an error message."""
+    return response.startswith(("Error", "File not found", "Unsupported file format"))
+
+
+def _tokens(text):
+    # Bypass the count cache, which is meant for repeated history messages
+    return count_tokens.__wrapped__(text)
+
+
+class MapReduceResult:
+    """Final answer of a map-reduce analysis and how much of the document it covered"""
+
+    def __init__(self, text, chunks_processed, chunks_failed, tokens_used, complete):
+        self.text = text
+        self.chunks_processed = chunks_processed
+        self.chunks_failed = chunks_failed
+        self.tokens_used = tokens_used
+        self.complete = complete
+
+    def summary(self):
+        """One-line description of the coverage, for showing with the answer."""
+        coverage = "the whole document" if self.complete else "the start of the document (token cap reached)"
+        failed = f", {self.chunks_failed} failed" if self.chunks_failed else ""
+        return (
+            f"Analyzed {self.chunks_processed} chunk(s){failed} covering {coverage}, "
+            f"about {self.tokens_used:,} tokens"
+        )
+
+    def render(self):
+        """The answer followed by its coverage, or just the error message if it failed."""
+        if is_failed_analysis(self.text):
+            return self.text
+        return f"{self.text}\n\n({self.summary()})"
+
+
+def _reduce_reserve(partial_count):
+    """Tokens to keep back for reducing partial_count partial results (an
+    upper estimate that also covers intermediate reduce levels)."""
+    return 2 * partial_count * PARTIAL_RESPONSE_TOKENS + FINAL_RESPONSE_TOKENS
+
+
+def map_reduce(llm_service, system_prompt, document, map_instruction, reduce_instruction,
+               chunk_tokens=MAP_REDUCE_CHUNK_TOKENS, max_tokens=MAP_REDUCE_MAX_TOKENS, workers=MAP_REDUCE_WORKERS):
+    """Analyze a document of any length within a token budget.
+
+    The document (a string or an iterable of text blocks) is split into
+    chunks of chunk_tokens tokens, each chunk is analyzed with
+    map_instruction by a bounded pool of workers, and the partial results
+    are reduced, in batches if they do not fit one prompt, into a final
+    answer following reduce_instruction. Chunks stop being read once the
+    estimated spend would exceed max_tokens.
+    """
+    system_tokens = _tokens(system_prompt)
+    chunks = iter_token_chunks(document, chunk_tokens)
+    try:
+        first = next(chunks, None)
+        second = next(chunks, None) if first is not None else None
+        if first is None:
+            return MapReduceResult("Error: the document is empty.", 0, 0, 0, True)
+
+        # A document that fits in one chunk needs a single call
+        if second is None:
+            prompt = f"{reduce_instruction}\n\nThe complete document:\n\n{first}"
+            response = llm_service.get_response(prompt, system_prompt, max_tokens=FINAL_RESPONSE_TOKENS)
+            failed = is_failed_analysis(response)
+            used = system_tokens + _tokens(prompt) + _tokens(response)
+            return MapReduceResult(response, 1, int(failed), used, True)
+
+        def pending_chunks():
+            yield first
+            yield second
+            yield from chunks
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            partials, failed, used, complete = _map(
+                llm_service, system_prompt, system_tokens, pending_chunks(), map_instruction,
+                max_tokens, workers, executor
+            )
+            if not partials:
+                reason = "every chunk failed to analyze" if failed else "the token cap is smaller than one chunk"
+                return MapReduceResult(f"Error: {reason}.", 0, failed, used, complete)
+            text, reduce_used = _reduce(
+                llm_service, system_prompt, system_tokens, partials, reduce_instruction, chunk_tokens, executor
+            )
+        return MapReduceResult(text, len(partials), failed, used + reduce_used, complete)
+    finally:
+        chunks.close()
+        # Release the underlying file of a lazily read document
+        if hasattr(document, 'close'):
+            document.close()
+
+
+def _map(llm_service, system_prompt, system_tokens, chunks, map_instruction, max_tokens, workers, executor):
+    """Run the map calls, at most workers at a time; returns (partials in
+    document order, failed count, tokens used, whether every chunk was read)."""
+    partials = {}
+    running = {}
+    failed = 0
+    used = 0
+    reserved = 0
+    index = 0
+    exhausted = capped = False
+    while True:
+        # Keep the pool busy without reading further ahead than needed
+        while not exhausted and not capped and len(running) < workers:
+            chunk = next(chunks, None)
+            if chunk is None:
+                exhausted = True
+                break
+            prompt = f"{map_instruction}\n\nPart {index + 1} of the document:\n\n{chunk}"
+            cost = system_tokens + _tokens(prompt) + PARTIAL_RESPONSE_TOKENS
+            if reserved + cost + _reduce_reserve(index + 1) > max_tokens:
+                capped = True
+                break
+            reserved += cost
+            future = executor.submit(
+                tracing.propagate(llm_service.get_response), prompt, system_prompt, max_tokens=PARTIAL_RESPONSE_TOKENS
+            )
+            running[future] = (index, prompt)
+            index += 1
+
+        if not running:
+            break
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            chunk_index, prompt = running.pop(future)
+            response = future.result()
+            used += system_tokens + _tokens(prompt) + _tokens(response)
+            if is_failed_analysis(response):
+                failed += 1
+            else:
+                partials[chunk_index] = response
+
+    return [partials[key] for key in sorted(partials)], failed, used, exhausted
+
+
+def _reduce(llm_service, system_prompt, system_tokens, partials, reduce_instruction, input_tokens, executor):
+    """Combine partial results into the final answer; returns (text, tokens used)."""
+    used = 0
+    notes = partials
+    # Combine consecutive notes in batches until they fit in one prompt
+    while len(notes) > 1 and sum(_tokens(note) for note in notes) > input_tokens:
+        batches = [[]]
+        batch_tokens = 0
+        for note in notes:
+            tokens = _tokens(note)
+            if batches[-1] and batch_tokens + tokens > input_tokens:
+                batches.append([])
+                batch_tokens = 0
+            batches[-1].append(note)
+            batch_tokens += tokens
+        if len(batches) == len(notes):
+            # Every note is too large to pair up; the final prompt gets them as they are
+            break
+
+        prompts = [
+            "Combine these notes on consecutive parts of a document into one set of notes, "
+            "keeping every figure, risk and issue:\n\n" + "\n\n".join(batch)
+            for batch in batches
+        ]
+        combine = tracing.propagate(llm_service.get_response)
+        futures = [
+            executor.submit(combine, prompt, system_prompt, max_tokens=PARTIAL_RESPONSE_TOKENS * 2)
+            for prompt in prompts
+        ]
+        combined = []
+        for prompt, batch, future in zip(prompts, batches, futures):
+            response = future.result()
+            used += system_tokens + _tokens(prompt) + _tokens(response)
+            if is_failed_analysis(response):
+                # Keep what fits of the original notes rather than losing the batch
+                response = truncate_to_tokens("\n\n".join(batch), PARTIAL_RESPONSE_TOKENS * 2)
+            combined.append(response)
+        notes = combined
+
+    prompt = (
+        f"{reduce_instruction}\n\nNotes from {len(notes)} consecutive part(s) of the document:\n\n" +
+        "\n\n".join(f"Part {index}:\n{note}" for index, note in enumerate(notes, start=1))
+    )
+    response = llm_service.get_response(prompt, system_prompt, max_tokens=FINAL_RESPONSE_TOKENS)
+    used += system_tokens + _tokens(prompt) + _tokens(response)
+    return response, used
@@ -0,0 +1,180 @@
+import os
+import pandas as pd
+from financial_analysis import detect_column_roles
+
+# Material line items listed individually per sheet, largest first
+MATERIAL_ITEM_LIMIT = int(os.environ.get("DATALIS_MATERIAL_ITEM_LIMIT", 50))
+# Accounts tracked for below-materiality aggregation before the rest are grouped as "other"
+MAX_TRACKED_ACCOUNTS = 5000
+# Accounts listed when their below-materiality items add up to a material amount
+RENDERED_AGGREGATE_ACCOUNTS = 10
+
+
+def _amount(value):
+    """Parse a threshold from the company info form; None when unset or not positive."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+class MaterialityThresholds:
+    """Overall materiality, performance materiality and clearly-trivial threshold (in ₹)"""
+
+    def __init__(self, overall=None, performance=None, trivial=None):
+        self.overall = _amount(overall)
+        self.performance = _amount(performance)
+        self.trivial = _amount(trivial)
+
+    @classmethod
+    def from_company_info(cls, company_info):
+        """Build thresholds from the company info form, or None if no threshold was entered."""
+        if not company_info or company_info.get("skipped", False):
+            return None
+        thresholds = cls(
+            company_info.get("overall_materiality"),
+            company_info.get("performance_materiality"),
+            company_info.get("trivial_threshold")
+        )
+        if thresholds.overall is None and thresholds.performance is None and thresholds.trivial is None:
+            return None
+        return thresholds
+
+    @property
+    def material(self):
+        """Amount at or above which a line item is listed individually."""
+        return self.performance if self.performance is not None else self.overall
+
+    def key(self):
+        """Stable string identifying these thresholds, for cache keys."""
+        return f"{self.overall}:{self.performance}:{self.trivial}"
+
+    def describe(self):
+        parts = []
+        if self.overall is not None:
+            parts.append(f"overall materiality ₹{self.overall:,.2f}")
+        if self.performance is not None:
+            parts.append(f"performance materiality ₹{self.performance:,.2f}")
+        if self.trivial is not None:
+            parts.append(f"clearly trivial below ₹{self.trivial:,.2f}")
+        return ", ".join(parts)
+
+
+class MaterialityFilter:
+    """Vectorized, chunked split of a table's line items by materiality.
+
+    Line items at or above performance materiality (or overall materiality
+    if no performance figure is set) are kept for listing, largest first;
+    clearly trivial items and those in between are only counted and totalled,
+    with the in-between items also aggregated per account so that many small
+    postings to one account that add up to a material amount are not lost.
+    """
+
+    def __init__(self, name, thresholds, max_items=MATERIAL_ITEM_LIMIT):
+        self.name = name
+        self.thresholds = thresholds
+        self.max_items = max_items
+        self.columns = None
+        self.amount_columns = []
+        self.account_column = None
+        self.row_count = 0
+        self.counts = {"material": 0, "intermediate": 0, "trivial": 0}
+        self.totals = {}
+        self.above_overall = 0
+        self.account_totals = pd.Series(dtype="float64")
+        self.account_counts = pd.Series(dtype="int64")
+        self.items = None
+
+    def _detect_columns(self, chunk):
+        self.columns = list(chunk.columns)
+        roles = detect_column_roles(chunk)
+        self.amount_columns = roles["amount"]
+        self.account_column = roles["account"]
+        self.totals = {band: pd.Series(0.0, index=self.amount_columns) for band in self.counts}
+
+    def update(self, chunk):
+        """Fold a DataFrame chunk into the running split."""
+        if self.columns is None:
+            self._detect_columns(chunk)
+        self.row_count += len(chunk)
+        if not self.amount_columns:
+            return
+
+        chunk = chunk.reindex(columns=self.columns)
+        amounts = chunk[self.amount_columns].apply(pd.to_numeric, errors="coerce")
+        # A line item's size is its largest absolute amount (e.g. the debit or the credit side)
+        sizes = amounts.abs().max(axis=1).fillna(0.0)
+
+        trivial = sizes < self.thresholds.trivial if self.thresholds.trivial is not None else sizes < 0
+        if self.thresholds.material is not None:
+            material = (sizes >= self.thresholds.material) & ~trivial
+        else:
+            material = ~trivial
+        intermediate = ~trivial & ~material
+
+        for band, mask in (("material", material), ("intermediate", intermediate), ("trivial", trivial)):
+            self.counts[band] += int(mask.sum())
+            self.totals[band] += amounts[mask].sum()
+        if self.thresholds.overall is not None:
+            self.above_overall += int((sizes >= self.thresholds.overall).sum())
+
+        # Per-account aggregation of the items that are not listed individually
+        if self.account_column is not None and intermediate.any():
+            accounts = chunk.loc[intermediate, self.account_column].astype(str)
+            if len(self.account_totals) >= MAX_TRACKED_ACCOUNTS:
+                accounts = accounts.where(accounts.isin(self.account_totals.index), "(other accounts)")
+            grouped = sizes[intermediate].groupby(accounts.values)
+            self.account_totals = self.account_totals.add(grouped.sum(), fill_value=0)
+            self.account_counts = self.account_counts.add(grouped.count(), fill_value=0)
+
+        # Keep only the largest material items seen so far
+        if material.any():
+            rows = chunk.loc[material].assign(_size=sizes[material])
+            rows = rows.nlargest(self.max_items, "_size")
+            if self.items is not None:
+                rows = pd.concat([self.items, rows], ignore_index=True).nlargest(self.max_items, "_size")
+            self.items = rows.reset_index(drop=True)
+
+    def _band_totals(self, band):
+        return ", ".join(f"{column}={total:,.2f}" for column, total in self.totals[band].items())
+
+    def render(self):
+        """Render the material items and trivial aggregates as prompt text."""
+        if not self.amount_columns:
+            return f"Materiality filter for {self.name}: no amount columns found."
+
+        material = self.thresholds.material
+        lines = [f"Materiality filter for {self.name} ({self.thresholds.describe()}), {self.row_count:,} rows:"]
+
+        label = f"at or above ₹{material:,.2f}" if material is not None else "above the trivial threshold"
+        listed = len(self.items) if self.items is not None else 0
+        lines.append(f"  Material items ({label}): {self.counts['material']:,} rows; {self._band_totals('material')}")
+        if self.thresholds.overall is not None:
+            lines.append(f"  Items at or above overall materiality: {self.above_overall:,}")
+        if listed:
+            shown = self.items.drop(columns="_size")
+            if self.thresholds.overall is not None:
+                shown.insert(0, "Over OM", self.items["_size"].ge(self.thresholds.overall).map({True: "*", False: ""}))
+            title = f"largest {listed:,}" if listed < self.counts["material"] else "all"
+            lines.append(f"  Material items listed ({title}):")
+            lines.append(shown.to_string(index=False))
+
+        if self.counts["intermediate"]:
+            lines.append(
+                f"  Below materiality, not clearly trivial: {self.counts['intermediate']:,} rows "
+                f"(aggregated, not listed); {self._band_totals('intermediate')}"
+            )
+            if material is not None and len(self.account_totals):
+                aggregated = self.account_totals[self.account_totals >= material].nlargest(RENDERED_AGGREGATE_ACCOUNTS)
+                if len(aggregated):
+                    lines.append(f"  Accounts whose below-materiality items add up to ₹{material:,.2f} or more:")
+                    for account, total in aggregated.items():
+                        lines.append(f"    {account}: {int(self.account_counts[account]):,} items, ₹{total:,.2f}")
+
+        if self.thresholds.trivial is not None:
+            lines.append(
+                f"  Clearly trivial (below ₹{self.thresholds.trivial:,.2f}): {self.counts['trivial']:,} rows "
+                f"(aggregated, not listed); {self._band_totals('trivial')}"
+            )
+        return "\n".join(lines)
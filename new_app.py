@@ -1,22 +1,38 @@
 import os
 import gradio as gr
 import time
+import uuid
 from file_handler import FileHandler
 from agent_factory import AgentFactory
 import dotenv
 from company_info import create_company_info_ui
+from session_store import SessionStore, remove_uploaded_files, uploaded_files_size
+from vector_index import VECTOR_INDEX
+from keyword_index import KEYWORD_INDEX
+import tracing
 
 # Load environment variables
 dotenv.load_dotenv()
 
-# Store uploaded files and company info
-uploaded_files = {}
+def end_session(session_id, files):
+    """Release the uploaded files and document indexes of an expired session"""
+    remove_uploaded_files(session_id, files)
+    VECTOR_INDEX.drop_session(session_id)
+    KEYWORD_INDEX.drop_session(session_id)
+
+# Store uploaded files and company info; idle sessions expire and their temp files are deleted
+uploaded_files = SessionStore(on_evict=end_session, size_of=uploaded_files_size)
 company_details = {}
 current_agent_name = "Dabby Consultant"
 available_agents = ["Dabby Consultant", "Auditor Agent", "Tax Agent"]
 
-# Initialize agent
-agent = AgentFactory.get_agent(current_agent_name)
+# Each session's selected agent; the agents themselves are shared
+agent_names = SessionStore()
+tracing.register_stats("sessions", uploaded_files.gauges)
+
+def get_agent(session_id):
+    """Get the agent selected in a session"""
+    return AgentFactory.get_agent(agent_names.get(session_id, current_agent_name))
 
 def upload_file(files, chatbot, session_id):
     """Handle file uploads"""
@@ -66,7 +82,7 @@ def analyze_file(file_name, chatbot, session_id):
     
     # Get response from agent
     try:
-        response = agent.analyze_file(file_name, selected_file["path"], session_id)
+        response = get_agent(session_id).analyze_file(file_name, selected_file["path"], session_id)
         
         # Update the last message with the actual response
         updated_chatbot[-1] = (f"Analyzing file: {file_name}", response)
@@ -89,10 +105,12 @@ def chat(message, chatbot, session_id):
     yield updated_chatbot
     
     try:
-        response = agent.chat(message, session_id)
-        
-        # Update chatbot
-        updated_chatbot[-1] = (message, response)
+        # Stream the answer into the chatbot as tokens arrive
+        response = ""
+        for delta in get_agent(session_id).stream_chat(message, session_id):
+            response += delta
+            updated_chatbot[-1] = (message, response)
+            yield updated_chatbot
     except Exception as e:
         # If there's an error, update the message accordingly
         updated_chatbot[-1] = (message, f"Error: {str(e)}")
@@ -101,14 +119,13 @@ def chat(message, chatbot, session_id):
 
 def change_agent(agent_name, session_id):
     """Change the current agent"""
-    global agent, current_agent_name
-    current_agent_name = agent_name
-    agent = AgentFactory.get_agent(agent_name)
+    agent_names[session_id] = agent_name
     
     return f"Agent switched to {agent_name}"
 
 def clear_chat(session_id):
     """Clear the chat history"""
+    agent = get_agent(session_id)
     if hasattr(agent, 'clear_history') and callable(agent.clear_history):
         agent.clear_history(session_id)
     elif hasattr(agent, 'conversation_history'):
@@ -118,6 +135,8 @@ def clear_chat(session_id):
 
 def create_ui():
     """Create the Gradio UI with home page and sidebar"""
+    # Serves /metrics when DATALIS_METRICS_PORT is set
+    tracing.start_metrics_server()
     with gr.Blocks(title="Datalis - AI-Powered Financial Intelligence", 
                   theme=gr.themes.Soft(), 
                   css="""
@@ -224,7 +243,9 @@ def create_ui():
             box-shadow: 0 10px 25px rgba(0, 0, 0, 0.1);
         }
     """) as app:
-        session_id = gr.State(value=str(time.time()))
+        # Each browser session gets its own id when the page loads
+        session_id = gr.State()
+        app.load(fn=lambda: str(uuid.uuid4()), outputs=[session_id])
         
         # Tabs for Home and Chat
         with gr.Tabs() as tabs:
@@ -354,10 +375,8 @@ def create_ui():
         )
         
         # Home page agent buttons to switch to chat tab with selected agent
+        # Setting the dropdown switches the session's agent through change_agent
         def select_agent_and_switch_tab(agent_name):
-            global agent, current_agent_name
-            current_agent_name = agent_name
-            agent = AgentFactory.get_agent(agent_name)
             return agent_name, gr.update(selected=1)
             
         dabby_btn.click(
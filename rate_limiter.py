@@ -0,0 +1,191 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import threading
+from tokens import count_message_tokens
+
+# Provider budgets shared by every LLM call in the process (0 disables a budget)
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get("DATALIS_LLM_REQUESTS_PER_MINUTE", 0))
+LLM_TOKENS_PER_MINUTE = int(os.environ.get("DATALIS_LLM_TOKENS_PER_MINUTE", 0))
+# Retries of a rate-limited or transiently failed call before the error is returned
+LLM_MAX_RETRIES = int(os.environ.get("DATALIS_LLM_MAX_RETRIES", 4))
+# Backoff before retry n is up to min(base * 2^n, max) seconds, randomly jittered
+LLM_BACKOFF_BASE_SECONDS = float(os.environ.get("DATALIS_LLM_BACKOFF_BASE_SECONDS", 1))
+LLM_BACKOFF_MAX_SECONDS = float(os.environ.get("DATALIS_LLM_BACKOFF_MAX_SECONDS", 30))
+
+# Request timeout, conflict, rate limit and server errors are worth retrying
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 429, 500, 502, 503, 504})
+
+
+def estimate_tokens(messages, max_tokens):
+    """Upper estimate of the tokens a request counts against the budget."""
+    return sum(count_message_tokens(message) for message in messages) + (max_tokens or 0)
+
+
+def status_code(error):
+    """HTTP status of an API error, or None for connection errors and bugs."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def retry_after(error):
+    """Seconds the provider asked us to wait, from the retry-after headers."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        # An HTTP date rather than seconds; fall back to backoff
+        pass
+    value = getattr(error, "retry_after", None)
+    return float(value) if isinstance(value, (int, float)) else None
+
+
+def is_retryable(error):
+    """Whether a failed call may succeed if sent again."""
+    # An SDK that is not loaded cannot have raised the error, so avoid importing it here
+    groq, httpx = sys.modules.get("groq"), sys.modules.get("httpx")
+    if groq is not None and isinstance(error, groq.APIConnectionError):
+        return True
+    if httpx is not None and isinstance(error, httpx.TransportError):
+        return True
+    return status_code(error) in RETRYABLE_STATUS_CODES
+
+
+class TokenBucket:
+    """Budget of units per minute, refilled continuously.
+
+    Reservations are taken immediately and may drive the level negative;
+    the caller then waits until the debt is refilled, so concurrent callers
+    are spaced out in arrival order without polling.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """Take amount from the bucket; returns the seconds to wait before using it."""
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount, now):
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """Process-wide requests- and tokens-per-minute limiter with retry backoff.
+
+    Every call reserves one request and its estimated tokens (prompt plus
+    max_tokens) before it is sent, and the unused part of the estimate is
+    refunded from the response's usage. A 429 pauses every caller for the
+    provider's retry-after, so one rate-limited call slows the whole process
+    down instead of each caller hammering the API in turn.
+    """
+
+    def __init__(self, requests_per_minute=LLM_REQUESTS_PER_MINUTE, tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+                 max_retries=LLM_MAX_RETRIES, backoff_base=LLM_BACKOFF_BASE_SECONDS,
+                 backoff_max=LLM_BACKOFF_MAX_SECONDS):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self.calls = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.retries = 0
+        self.retried_seconds = 0.0
+        self.retries_by_reason = {}
+        self.failures = 0
+
+    def _reserve(self, tokens):
+        now = time.monotonic()
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self._paused_until - now)
+            if self.requests is not None:
+                delay = max(delay, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                delay = max(delay, self.tokens.reserve(tokens, now))
+            if delay > 0:
+                self.throttled += 1
+                self.throttled_seconds += delay
+        return delay
+
+    def acquire(self, tokens):
+        """Block until a request of about tokens tokens fits the budgets."""
+        delay = self._reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self, tokens):
+        """Async variant of acquire."""
+        delay = self._reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def settle(self, reserved, used):
+        """Give back the part of a reservation the request did not use."""
+        if self.tokens is None or used is None or used >= reserved:
+            return
+        with self._lock:
+            self.tokens.refund(reserved - used, time.monotonic())
+
+    def retry_delay(self, error, attempt):
+        """Seconds to wait before retrying a failed call, or None to give up."""
+        if not is_retryable(error) or attempt >= self.max_retries:
+            with self._lock:
+                self.failures += 1
+            return None
+
+        backoff = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        hint = retry_after(error)
+        with self._lock:
+            if hint is not None:
+                delay = min(hint, self.backoff_max) + self._random.uniform(0, self.backoff_base)
+            else:
+                delay = self._random.uniform(backoff / 2, backoff)
+            status = status_code(error)
+            if status == 429:
+                # The provider is out of budget for everyone, not just this call
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            reason = str(status) if status is not None else "connection"
+            self.retries += 1
+            self.retried_seconds += delay
+            self.retries_by_reason[reason] = self.retries_by_reason.get(reason, 0) + 1
+        return delay
+
+    def stats(self):
+        """Return throttling and retry counters for monitoring."""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "throttled": self.throttled,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+                "retries": self.retries,
+                "retried_seconds": round(self.retried_seconds, 3),
+                "retries_by_reason": dict(self.retries_by_reason),
+                "failures": self.failures,
+            }
+
+
+# Shared by every LLMService instance, since provider limits apply per API key
+RATE_LIMITER = RateLimiter()
@@ -1,10 +1,16 @@
 """
 Dabby Demo - Financial Intelligence Application with Agent Selection Sidebar
+
+    python run_app.py                      # check requirements and start the app
+    python run_app.py --startup-report     # show which imports slow down startup
 """
 import os
 import sys
-from importlib import import_module
-import pkg_resources
+import json
+import hashlib
+import argparse
+import tempfile
+from importlib import metadata
 
 # List of required packages
 REQUIRED_PACKAGES = [
@@ -12,21 +18,57 @@ REQUIRED_PACKAGES = [
     "python-dotenv>=1.0.0",
     "groq>=0.4.0", 
     "pandas>=2.0.0",
-    "docx>=0.2.4",
     "PyPDF2>=3.0.0",
     "python-docx>=0.8.11",
 ]
 
-def check_requirements():
-    """Check if all required packages are installed"""
+# Set in production images, where requirements are installed at build time
+SKIP_REQUIREMENTS_CHECK = os.environ.get("DATALIS_SKIP_REQUIREMENTS_CHECK", "").lower() in ("1", "true", "yes")
+# Remembers the last successful check so unchanged environments are not re-scanned
+REQUIREMENTS_STAMP = os.path.join(tempfile.gettempdir(), "datalis_requirements.json")
+
+def _environment_key():
+    """Fingerprint of the interpreter, the requirement list and the installed packages."""
+    # Installing or removing a package changes the mtime of its site-packages directory
+    site_dirs = [path for path in sys.path if path.endswith(("site-packages", "dist-packages")) and os.path.isdir(path)]
+    state = [sys.executable, REQUIRED_PACKAGES] + [[path, os.stat(path).st_mtime_ns] for path in site_dirs]
+    return hashlib.sha256(json.dumps(state).encode('utf-8')).hexdigest()
+
+def _read_stamp():
+    try:
+        with open(REQUIREMENTS_STAMP, 'r', encoding='utf-8') as file:
+            return json.load(file).get("key")
+    except (OSError, ValueError):
+        return None
+
+def _write_stamp(key):
+    try:
+        with open(REQUIREMENTS_STAMP, 'w', encoding='utf-8') as file:
+            json.dump({"key": key}, file)
+    except OSError as e:
+        print(f"Error saving requirements check: {str(e)}")
+
+def find_missing_packages():
+    """Return the required packages that are not installed."""
     missing = []
     for package in REQUIRED_PACKAGES:
         package_name = package.split('>=')[0]
         try:
-            pkg_resources.get_distribution(package_name)
-        except pkg_resources.DistributionNotFound:
+            metadata.version(package_name)
+        except metadata.PackageNotFoundError:
             missing.append(package)
-    
+    return missing
+
+def check_requirements():
+    """Check if all required packages are installed"""
+    if SKIP_REQUIREMENTS_CHECK:
+        return
+
+    key = _environment_key()
+    if _read_stamp() == key:
+        return
+
+    missing = find_missing_packages()
     if missing:
         print(f"Missing required packages: {', '.join(missing)}")
         print("Installing missing packages...")
@@ -42,6 +84,46 @@ def check_requirements():
             for package in missing:
                 print(f"  pip install {package}")
             sys.exit(1)
+        # The install itself changed the environment
+        key = _environment_key()
+
+    _write_stamp(key)
+
+def startup_report(module="new_app", top=15):
+    """Import a module in a fresh interpreter under -X importtime and print
+    the total import time and the slowest top-level and individual imports."""
+    import subprocess
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+
+    # Lines look like "import time:  self [us] | cumulative | <indent>module"
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((int(self_us), int(cumulative_us), depth, name.strip()))
+
+    if result.returncode != 0:
+        print(f"Error importing {module}:")
+        print("\n".join(line for line in result.stderr.splitlines() if not line.startswith("import time:")))
+        return result.returncode
+
+    top_level = [entry for entry in imports if entry[2] == 0]
+    total_ms = sum(cumulative for _, cumulative, _, _ in top_level) / 1000
+    print(f"Importing {module} took {total_ms:,.0f} ms across {len(imports)} modules")
+
+    print("\nSlowest top-level imports (ms, including their dependencies):")
+    for _, cumulative, _, name in sorted(top_level, key=lambda entry: entry[1], reverse=True)[:top]:
+        print(f"  {cumulative / 1000:8.1f}  {name}")
+
+    print("\nSlowest individual modules (ms, excluding their dependencies):")
+    for self_us, _, _, name in sorted(imports, key=lambda entry: entry[0], reverse=True)[:top]:
+        print(f"  {self_us / 1000:8.1f}  {name}")
+    return 0
 
 def run_app():
     """Run the Dabby Demo application"""
@@ -53,8 +135,20 @@ def run_app():
     app.launch(share=False)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start the Datalis app")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="Print an import time report for the app instead of starting it")
+    parser.add_argument("--module", default="new_app", help="Module to profile with --startup-report")
+    parser.add_argument("--skip-requirements-check", action="store_true",
+                        help="Do not check installed packages (also DATALIS_SKIP_REQUIREMENTS_CHECK=1)")
+    args = parser.parse_args()
+
+    if args.startup_report:
+        sys.exit(startup_report(args.module))
+
     # Check if all required packages are installed
-    check_requirements()
+    if not args.skip_requirements_check:
+        check_requirements()
     
     # Check if GROQ_API_KEY environment variable is set
     if not os.environ.get("GROQ_API_KEY"):
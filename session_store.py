@@ -0,0 +1,178 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Sessions idle longer than this are evicted
+SESSION_TTL_SECONDS = float(os.environ.get("DATALIS_SESSION_TTL_SECONDS", 4 * 60 * 60))
+# Least recently used sessions are evicted beyond this many
+SESSION_MAX_SESSIONS = int(os.environ.get("DATALIS_SESSION_MAX_SESSIONS", 500))
+# Each session's uploads are linked or copied under here, since the UI hands
+# sessions that upload identical content the same path
+UPLOAD_DIR = os.environ.get("DATALIS_UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "datalis_uploads"))
+
+
+class SessionStore:
+    """Dict-like per-session store with idle expiry and LRU eviction.
+
+    Reading or writing a session refreshes it. Evicted values are passed to
+    on_evict(session_id, value) so callers can release what they reference,
+    and size_of(value) feeds the bytes_held gauge.
+    """
+
+    def __init__(self, ttl=SESSION_TTL_SECONDS, max_sessions=SESSION_MAX_SESSIONS, on_evict=None, size_of=None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.on_evict = on_evict
+        self.size_of = size_of
+        self._data = OrderedDict()
+        self._touched = {}
+        self._lock = threading.RLock()
+        self.evictions = 0
+
+    def _touch(self, session_id):
+        self._touched[session_id] = time.monotonic()
+        self._data.move_to_end(session_id)
+
+    def _evict_expired(self):
+        """Drop expired and over-capacity sessions; returns the evicted items."""
+        evicted = []
+        now = time.monotonic()
+        while self._data:
+            session_id = next(iter(self._data))
+            expired = self.ttl is not None and now - self._touched[session_id] > self.ttl
+            over_capacity = self.max_sessions is not None and len(self._data) > self.max_sessions
+            if not expired and not over_capacity:
+                break
+            evicted.append((session_id, self._data.pop(session_id)))
+            del self._touched[session_id]
+            self.evictions += 1
+        return evicted
+
+    def _release(self, evicted):
+        # Callbacks run outside the lock so they can do slow I/O
+        if self.on_evict:
+            for session_id, value in evicted:
+                try:
+                    self.on_evict(session_id, value)
+                except Exception as e:
+                    print(f"Error cleaning up session {session_id}: {str(e)}")
+
+    def __contains__(self, session_id):
+        with self._lock:
+            evicted = self._evict_expired()
+            found = session_id in self._data
+        self._release(evicted)
+        return found
+
+    def __getitem__(self, session_id):
+        with self._lock:
+            evicted = self._evict_expired()
+            found = session_id in self._data
+            if found:
+                self._touch(session_id)
+                value = self._data[session_id]
+        self._release(evicted)
+        if not found:
+            raise KeyError(session_id)
+        return value
+
+    def __setitem__(self, session_id, value):
+        with self._lock:
+            self._data[session_id] = value
+            self._touch(session_id)
+            evicted = self._evict_expired()
+        self._release(evicted)
+
+    def __delitem__(self, session_id):
+        with self._lock:
+            value = self._data.pop(session_id)
+            del self._touched[session_id]
+        self._release([(session_id, value)])
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get(self, session_id, default=None):
+        """Return a session's value, or default if there is none."""
+        try:
+            return self[session_id]
+        except KeyError:
+            return default
+
+    def setdefault(self, session_id, default):
+        """Return a session's value, storing default first if there is none."""
+        with self._lock:
+            if session_id not in self._data:
+                self._data[session_id] = default
+            self._touch(session_id)
+            value = self._data[session_id]
+            evicted = self._evict_expired()
+        self._release(evicted)
+        return value
+
+    def pop(self, session_id, default=None):
+        """Remove a session, running the eviction callback, and return its value."""
+        with self._lock:
+            if session_id not in self._data:
+                return default
+            value = self._data.pop(session_id)
+            del self._touched[session_id]
+        self._release([(session_id, value)])
+        return value
+
+    def sweep(self):
+        """Evict expired sessions now; returns how many were evicted."""
+        with self._lock:
+            evicted = self._evict_expired()
+        self._release(evicted)
+        return len(evicted)
+
+    def gauges(self):
+        """Return live session count, bytes held and eviction total."""
+        with self._lock:
+            values = list(self._data.values())
+            live = len(values)
+            evictions = self.evictions
+        bytes_held = 0
+        if self.size_of:
+            for value in values:
+                try:
+                    bytes_held += self.size_of(value)
+                except Exception:
+                    pass
+        return {"live_sessions": live, "bytes_held": bytes_held, "evictions": evictions}
+
+
+def uploaded_files_size(files):
+    """Total size on disk of a session's uploaded files."""
+    total = 0
+    for file in files:
+        try:
+            total += os.path.getsize(file["path"])
+        except OSError:
+            pass
+    return total
+
+
+def session_upload_dir(session_id):
+    """Directory holding a session's own copies of its uploaded files."""
+    return os.path.join(UPLOAD_DIR, str(session_id))
+
+
+def remove_uploaded_files(session_id, files):
+    """Delete an evicted session's copies of its uploads (other sessions keep theirs)."""
+    directory = session_upload_dir(session_id)
+    try:
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+    except OSError as e:
+        print(f"Error removing uploads of session {session_id}: {str(e)}")
+
+
+def history_size(history):
+    """Approximate size in bytes of a conversation history."""
+    return sum(len(message.get("content") or "") for message in history)
@@ -0,0 +1,195 @@
+import os
+from collections import deque
+import numpy as np
+import pandas as pd
+from financial_analysis import FinancialPreAnalysis
+from materiality import MaterialityFilter
+
+# Rows read per chunk; peak memory is bounded by this, not by the file size
+TABULAR_CHUNK_ROWS = int(os.environ.get("DATALIS_TABULAR_CHUNK_ROWS", 20000))
+# Rows shown from the start and end of each sheet
+TABULAR_SAMPLE_ROWS = int(os.environ.get("DATALIS_TABULAR_SAMPLE_ROWS", 5))
+# Distinct values tracked per text column before reporting "N+"
+MAX_TRACKED_DISTINCT = 1000
+
+
+def iter_csv_chunks(file_path, chunk_rows=TABULAR_CHUNK_ROWS):
+    """Yield ("CSV", DataFrame chunk) pairs for a CSV file."""
+    for chunk in pd.read_csv(file_path, chunksize=chunk_rows, low_memory=True):
+        yield "CSV", chunk
+
+
+def iter_excel_chunks(file_path, chunk_rows=TABULAR_CHUNK_ROWS):
+    """Yield (sheet name, DataFrame chunk) pairs for every sheet of a workbook."""
+    if file_path.lower().endswith('.xlsx'):
+        # openpyxl's read-only mode streams rows instead of loading whole sheets
+        import openpyxl
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            for sheet in workbook.worksheets:
+                rows = sheet.iter_rows(values_only=True)
+                header = next(rows, None)
+                if header is None:
+                    continue
+                columns = _column_names(header)
+                block = []
+                for row in rows:
+                    block.append(row[:len(columns)])
+                    if len(block) >= chunk_rows:
+                        yield sheet.title, _frame(block, columns)
+                        block = []
+                if block:
+                    yield sheet.title, _frame(block, columns)
+        finally:
+            workbook.close()
+    else:
+        # Legacy .xls files cannot be streamed; read them one sheet at a time
+        sheet_names = pd.ExcelFile(file_path).sheet_names
+        for sheet_name in sheet_names:
+            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            for start in range(0, len(df), chunk_rows):
+                yield sheet_name, df.iloc[start:start + chunk_rows]
+
+
+def _column_names(header):
+    names = []
+    for index, value in enumerate(header):
+        name = str(value) if value is not None else f"Unnamed: {index}"
+        names.append(name)
+    return names
+
+
+def _frame(block, columns):
+    # Cells arrive as Python objects; let pandas infer numeric dtypes
+    return pd.DataFrame.from_records(block, columns=columns).infer_objects()
+
+
+class TabularSummary:
+    """Single-pass, bounded-memory summary of one table read in chunks"""
+
+    def __init__(self, name, sample_rows=TABULAR_SAMPLE_ROWS):
+        self.name = name
+        self.sample_rows = sample_rows
+        self.row_count = 0
+        self.columns = None
+        self.numeric_columns = None
+        self.nulls = None
+        self.sums = None
+        self.mins = None
+        self.maxs = None
+        self.counts = None
+        self.distinct = {}
+        self.head = None
+        self.tail = deque(maxlen=sample_rows)
+
+    def update(self, chunk):
+        """Fold a DataFrame chunk into the running summary."""
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+            # Column types are inferred from the first chunk and enforced afterwards
+            self.numeric_columns = [
+                column for column in self.columns if pd.api.types.is_numeric_dtype(chunk[column])
+            ]
+            self.nulls = pd.Series(0, index=self.columns, dtype="int64")
+            self.sums = pd.Series(0.0, index=self.numeric_columns)
+            self.counts = pd.Series(0, index=self.numeric_columns, dtype="int64")
+            self.mins = pd.Series(np.inf, index=self.numeric_columns)
+            self.maxs = pd.Series(-np.inf, index=self.numeric_columns)
+            self.head = chunk.head(self.sample_rows)
+
+        chunk = chunk.reindex(columns=self.columns)
+        self.row_count += len(chunk)
+        self.nulls = self.nulls.add(chunk.isna().sum(), fill_value=0).astype("int64")
+
+        if self.numeric_columns:
+            numbers = chunk[self.numeric_columns].apply(pd.to_numeric, errors="coerce")
+            self.sums += numbers.sum()
+            self.counts += numbers.count()
+            self.mins = np.fmin(self.mins, numbers.min())
+            self.maxs = np.fmax(self.maxs, numbers.max())
+
+        for column in self.columns:
+            if column in self.numeric_columns:
+                continue
+            seen = self.distinct.setdefault(column, set())
+            if len(seen) < MAX_TRACKED_DISTINCT:
+                # Stop at the cap; values already seen do not use up room
+                for value in chunk[column].dropna().astype(str).unique():
+                    if len(seen) >= MAX_TRACKED_DISTINCT:
+                        break
+                    seen.add(value)
+
+        for row in chunk.tail(self.sample_rows).itertuples(index=False):
+            self.tail.append(row)
+
+    def render(self):
+        """Render the summary as compact prompt text."""
+        if self.columns is None:
+            return f"Sheet: {self.name} (empty)"
+
+        lines = [f"Sheet: {self.name} - {self.row_count:,} rows x {len(self.columns)} columns", "Columns:"]
+        for column in self.columns:
+            if column in self.numeric_columns:
+                kind = "numeric"
+            else:
+                distinct = len(self.distinct.get(column, ()))
+                kind = f"text, {distinct}{'+' if distinct >= MAX_TRACKED_DISTINCT else ''} distinct"
+            lines.append(f"  {column} ({kind}, {int(self.nulls[column])} nulls)")
+
+        if self.numeric_columns:
+            lines.append("Numeric summary:")
+            for column in self.numeric_columns:
+                count = int(self.counts[column])
+                if not count:
+                    continue
+                total = self.sums[column]
+                lines.append(
+                    f"  {column}: sum={total:,.2f} mean={total / count:,.2f} "
+                    f"min={self.mins[column]:,.2f} max={self.maxs[column]:,.2f}"
+                )
+
+        lines.append(f"First {len(self.head)} rows:")
+        lines.append(self.head.to_string(index=False))
+        if self.row_count > len(self.head):
+            lines.append(f"Last {len(self.tail)} rows:")
+            lines.append(pd.DataFrame(list(self.tail), columns=self.columns).to_string(index=False))
+        return "\n".join(lines)
+
+
+def analyze_chunks(chunks):
+    """Summarize and pre-analyze (sheet name, chunk) pairs in one pass.
+
+    Returns a (TabularSummary, FinancialPreAnalysis) pair per sheet, in order.
+    """
+    sheets = {}
+    for sheet_name, chunk in chunks:
+        if sheet_name not in sheets:
+            sheets[sheet_name] = (TabularSummary(sheet_name), FinancialPreAnalysis(sheet_name))
+        summary, analysis = sheets[sheet_name]
+        summary.update(chunk)
+        analysis.update(chunk)
+    return list(sheets.values())
+
+
+def iter_tabular_chunks(file_path, chunk_rows=TABULAR_CHUNK_ROWS):
+    """Yield (sheet name, chunk) pairs for a CSV or Excel file."""
+    if file_path.lower().endswith('.csv'):
+        return iter_csv_chunks(file_path, chunk_rows)
+    return iter_excel_chunks(file_path, chunk_rows)
+
+
+def summarize_tabular_file(file_path):
+    """Return the compact text representation and computed facts of every sheet in a CSV or Excel file."""
+    sheets = analyze_chunks(iter_tabular_chunks(file_path))
+    return "\n\n".join(summary.render() + "\n" + analysis.render() for summary, analysis in sheets)
+
+
+def material_items_for_file(file_path, thresholds):
+    """Return the materiality split (material items listed, the rest aggregated)
+    of every sheet in a CSV or Excel file."""
+    sheets = {}
+    for sheet_name, chunk in iter_tabular_chunks(file_path):
+        if sheet_name not in sheets:
+            sheets[sheet_name] = MaterialityFilter(sheet_name, thresholds)
+        sheets[sheet_name].update(chunk)
+    return "\n\n".join(materiality.render() for materiality in sheets.values())
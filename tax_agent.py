@@ -1,4 +1,5 @@
-from base_agent import BaseAgent
+from base_agent import BaseAgent, ANALYSIS_MODE
+from file_handler import FileHandler
 
 class TaxAgent(BaseAgent):
     """Tax Agent implementation"""
@@ -13,14 +14,31 @@ class TaxAgent(BaseAgent):
 Provide accurate tax advice, identify potential deductions, and explain tax implications clearly.
 Always cite relevant tax codes and regulations when applicable."""
     
-    def analyze_tax_documents(self, document_texts):
-        """Analyze tax documents for insights and compliance issues."""
-        # Combine texts and get a representative sample
-        combined_text = "\n\n".join([text[:3000] for text in document_texts])
+    def analyze_tax_documents(self, document_texts, mode=None):
+        """Analyze tax documents for insights and compliance issues.
+
+        With mode "map_reduce" every document is read in full, chunk by
+        chunk, instead of only its first 3,000 characters. Defaults to
+        DATALIS_ANALYSIS_MODE.
+        """
+        instruction = (
+            "Identify key tax considerations, potential deductions, compliance issues, and tax planning opportunities."
+        )
+        
+        if (mode or ANALYSIS_MODE) == "map_reduce":
+            result = self.map_reduce_analysis(
+                self.iter_documents(document_texts),
+                "Note the tax-relevant facts, figures, deductions and compliance issues in this part of the tax documents.",
+                "Analyze these tax documents from the material below. " + instruction
+            )
+            return result.render()
+        
+        # Combine texts and get a representative sample; documents may be
+        # strings or lazy block iterators from FileHandler.iter_file_content
+        combined_text = "\n\n".join([FileHandler.take_text(text, 3000) for text in document_texts])
         
         prompt = (
-            f"Analyze these tax documents:\n\n{combined_text}\n\n"
-            "Identify key tax considerations, potential deductions, compliance issues, and tax planning opportunities."
+            f"Analyze these tax documents:\n\n{combined_text}\n\n" + instruction
         )
                 
         return self.llm_service.get_response(prompt, self.system_prompt)
@@ -36,8 +54,9 @@ Always cite relevant tax codes and regulations when applicable."""
     
     def suggest_tax_planning(self, document_texts):
         """Suggest tax planning strategies based on documents."""
-        # Combine texts and get a representative sample
-        combined_text = "\n\n".join([text[:3000] for text in document_texts])
+        # Combine texts and get a representative sample; documents may be
+        # strings or lazy block iterators from FileHandler.iter_file_content
+        combined_text = "\n\n".join([FileHandler.take_text(text, 3000) for text in document_texts])
         
         prompt = (
             f"Based on these financial documents:\n\n{combined_text}\n\n"
@@ -0,0 +1,92 @@
+import functools
+import threading
+
+# tiktoken only approximates the Llama tokenizer, which is close enough for budgeting
+TOKEN_ENCODING = "cl100k_base"
+
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    """Load the tiktoken encoding on first use; None if it is unavailable."""
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        # Loading may download the encoding, so concurrent first callers wait for one load
+        with _encoding_lock:
+            if _encoding is None and not _encoding_failed:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+                except Exception as e:
+                    # e.g. tiktoken missing or the encoding file cannot be downloaded
+                    print(f"Token counting falls back to an estimate: {str(e)}")
+                    _encoding_failed = True
+    return _encoding
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text):
+    """Count the tokens in a piece of text."""
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message):
+    """Count the tokens of one chat message, including per-message overhead."""
+    return count_tokens(message.get("content") or "") + 4
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text down to at most max_tokens tokens."""
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def iter_token_chunks(document, max_tokens):
+    """Split a document into chunks of at most max_tokens tokens.
+
+    document is a string or an iterable of text blocks (such as
+    FileHandler.iter_file_content); blocks are kept whole where they fit,
+    so chunks break at page, paragraph or line boundaries, and blocks that are
+    too large on their own are cut at token boundaries.
+    """
+    # A whole document given as one string is split at line breaks
+    blocks = document.splitlines(keepends=True) if isinstance(document, str) else document
+    parts = []
+    used = 0
+    for block in blocks:
+        # Bypass the count cache, which is meant for repeated history messages
+        tokens = count_tokens.__wrapped__(block)
+        if tokens > max_tokens:
+            if parts:
+                yield "".join(parts)
+                parts, used = [], 0
+            yield from _split_block(block, max_tokens)
+            continue
+        if used + tokens > max_tokens and parts:
+            yield "".join(parts)
+            parts, used = [], 0
+        parts.append(block)
+        used += tokens
+    if parts:
+        yield "".join(parts)
+
+
+def _split_block(text, max_tokens):
+    encoding = _get_encoding()
+    if encoding is None:
+        for start in range(0, len(text), max_tokens * 4):
+            yield text[start:start + max_tokens * 4]
+        return
+    tokens = encoding.encode(text, disallowed_special=())
+    for start in range(0, len(tokens), max_tokens):
+        yield encoding.decode(tokens[start:start + max_tokens])
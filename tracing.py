@@ -0,0 +1,308 @@
+import os
+import re
+import json
+import time
+import threading
+import contextvars
+
+# Spans are appended to this JSONL file, one object per line (unset: not written)
+TRACE_FILE = os.environ.get("DATALIS_TRACE_FILE") or None
+# Port of the Prometheus text endpoint at /metrics (0: not served)
+METRICS_PORT = int(os.environ.get("DATALIS_METRICS_PORT", 0))
+# Tracing is on when either export is configured, or explicitly for in-process metrics
+TRACING_ENABLED = (
+    os.environ.get("DATALIS_TRACING", "").lower() in ("1", "true", "yes") or bool(TRACE_FILE) or bool(METRICS_PORT)
+)
+
+# Upper bounds (seconds) of the span duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_enabled = TRACING_ENABLED
+_current = contextvars.ContextVar("datalis_span", default=None)
+_lock = threading.Lock()
+_trace_file = None
+_metrics = {}
+_stats_sources = {}
+_metrics_server = None
+
+
+class _NoopSpan:
+    """Stand-in returned while tracing is disabled; every operation does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """A timed operation with attributes, nested under the span active when it starts"""
+
+    __slots__ = ("name", "attributes", "trace_id", "span_id", "parent_id", "start", "duration", "error",
+                 "_started", "_token")
+
+    def __init__(self, name, attributes):
+        parent = _current.get()
+        self.name = name
+        self.attributes = attributes
+        self.span_id = os.urandom(8).hex()
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.parent_id = parent.span_id if parent is not None else None
+        self.error = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._started
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # A generator span can finish in a different context than it started in
+            pass
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        _finish(self)
+        return False
+
+    def set(self, **attributes):
+        """Add attributes, e.g. token counts or cache_hit, while the span is open."""
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        record = {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": round(self.start, 6),
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+        }
+        if self.error is not None:
+            record["error"] = self.error
+        return record
+
+
+class _SpanMetrics:
+    """Aggregated durations, errors, cache results and token counts of one span name"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.cache = {"hit": 0, "miss": 0}
+        self.tokens = {}
+
+    def add(self, span):
+        self.count += 1
+        self.total += span.duration
+        for index, bound in enumerate(DURATION_BUCKETS):
+            if span.duration <= bound:
+                self.buckets[index] += 1
+                break
+        if span.error is not None:
+            self.errors += 1
+        cache_hit = span.attributes.get("cache_hit")
+        if cache_hit is not None:
+            self.cache["hit" if cache_hit else "miss"] += 1
+        for key, value in span.attributes.items():
+            if key.endswith("_tokens") and isinstance(value, (int, float)):
+                kind = key[:-len("_tokens")]
+                self.tokens[kind] = self.tokens.get(kind, 0) + value
+
+
+def is_enabled():
+    """Whether spans are currently being recorded."""
+    return _enabled
+
+
+def enable(trace_file=None):
+    """Turn tracing on at runtime, optionally (re)directing spans to a JSONL file."""
+    global _enabled, TRACE_FILE, _trace_file
+    with _lock:
+        if trace_file is not None and trace_file != TRACE_FILE:
+            if _trace_file is not None:
+                _trace_file.close()
+                _trace_file = None
+            TRACE_FILE = trace_file
+        _enabled = True
+
+
+def disable():
+    """Turn tracing off; spans already recorded stay in the metrics."""
+    global _enabled
+    _enabled = False
+
+
+def span(name, **attributes):
+    """Context manager timing an operation: `with span("llm.request", model=m) as s: ... s.set(x=1)`.
+
+    While tracing is disabled this returns a shared no-op object, so an
+    instrumented hot path costs one function call and a flag check.
+    """
+    if not _enabled:
+        return _NOOP_SPAN
+    return Span(name, attributes)
+
+
+def propagate(function):
+    """Wrap a function submitted to an executor so its spans nest under the current span."""
+    if not _enabled:
+        return function
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # Each call gets its own copy, since one context cannot be entered by two threads at once
+        return context.copy().run(function, *args, **kwargs)
+    return run
+
+
+def _finish(span):
+    global _trace_file
+    with _lock:
+        metrics = _metrics.get(span.name)
+        if metrics is None:
+            metrics = _metrics[span.name] = _SpanMetrics()
+        metrics.add(span)
+        if TRACE_FILE is None:
+            return
+        try:
+            if _trace_file is None:
+                directory = os.path.dirname(TRACE_FILE)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                # Line buffered so every finished span is on disk
+                _trace_file = open(TRACE_FILE, 'a', encoding='utf-8', buffering=1)
+            _trace_file.write(json.dumps(span.to_dict(), default=str) + "\n")
+        except OSError as e:
+            print(f"Error writing trace: {str(e)}")
+
+
+def register_stats(name, stats):
+    """Export a component's stats() dict (nested dicts of numbers) as gauges
+    named datalis_<name>_<key path>, read each time metrics are rendered."""
+    with _lock:
+        _stats_sources[name] = stats
+
+
+def _metric_name(*parts):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join(str(part) for part in parts if part != ""))
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _flatten(prefix, value, lines):
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, (int, float)):
+        lines.append(f"{prefix} {value}")
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            _flatten(_metric_name(prefix, key), item, lines)
+
+
+def render_metrics():
+    """Render span metrics and registered stats in the Prometheus text format."""
+    with _lock:
+        spans = {
+            name: (metrics.count, metrics.errors, metrics.total, list(metrics.buckets), dict(metrics.cache),
+                   dict(metrics.tokens))
+            for name, metrics in _metrics.items()
+        }
+        sources = dict(_stats_sources)
+
+    lines = [
+        "# HELP datalis_span_duration_seconds Duration of traced operations",
+        "# TYPE datalis_span_duration_seconds histogram",
+    ]
+    for name, (count, _, total, buckets, _, _) in sorted(spans.items()):
+        cumulative = 0
+        for bound, bucket in zip(DURATION_BUCKETS, buckets):
+            cumulative += bucket
+            lines.append(f'datalis_span_duration_seconds_bucket{{span="{_label(name)}",le="{bound}"}} {cumulative}')
+        lines.append(f'datalis_span_duration_seconds_bucket{{span="{_label(name)}",le="+Inf"}} {count}')
+        lines.append(f'datalis_span_duration_seconds_sum{{span="{_label(name)}"}} {total:.6f}')
+        lines.append(f'datalis_span_duration_seconds_count{{span="{_label(name)}"}} {count}')
+
+    lines += ["# HELP datalis_span_errors_total Traced operations that raised",
+              "# TYPE datalis_span_errors_total counter"]
+    for name, (_, errors, _, _, _, _) in sorted(spans.items()):
+        lines.append(f'datalis_span_errors_total{{span="{_label(name)}"}} {errors}')
+
+    lines += ["# HELP datalis_span_cache_total Cache hits and misses of traced operations",
+              "# TYPE datalis_span_cache_total counter"]
+    for name, (_, _, _, _, cache, _) in sorted(spans.items()):
+        if cache["hit"] or cache["miss"]:
+            for result, count in cache.items():
+                lines.append(f'datalis_span_cache_total{{span="{_label(name)}",result="{result}"}} {count}')
+
+    lines += ["# HELP datalis_span_tokens_total LLM tokens counted by traced operations",
+              "# TYPE datalis_span_tokens_total counter"]
+    for name, (_, _, _, _, _, tokens) in sorted(spans.items()):
+        for kind, count in sorted(tokens.items()):
+            lines.append(f'datalis_span_tokens_total{{span="{_label(name)}",kind="{_label(kind)}"}} {count}')
+
+    for name, stats in sorted(sources.items()):
+        try:
+            values = stats()
+        except Exception as e:
+            print(f"Error reading {name} stats: {str(e)}")
+            continue
+        gauges = []
+        _flatten(_metric_name("datalis", name), values, gauges)
+        for gauge in gauges:
+            lines.append(f"# TYPE {gauge.split(' ')[0]} gauge")
+            lines.append(gauge)
+    return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(port=None, host="127.0.0.1"):
+    """Serve /metrics from a daemon thread (once per process); no-op without a port."""
+    global _metrics_server
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    # Only imported when the endpoint is configured
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes would otherwise be logged to stderr every few seconds
+            pass
+
+    with _lock:
+        if _metrics_server is None:
+            try:
+                _metrics_server = ThreadingHTTPServer((host, port), MetricsHandler)
+            except OSError as e:
+                print(f"Error starting metrics server on port {port}: {str(e)}")
+                return None
+            threading.Thread(
+                target=_metrics_server.serve_forever, name="datalis-metrics", daemon=True
+            ).start()
+        return _metrics_server
@@ -0,0 +1,227 @@
+import os
+import re
+import json
+import zlib
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+import tracing
+from cache import LRUCache
+from session_store import SessionStore
+from tokens import iter_token_chunks
+
+# Bump when the chunking or embedding changes so persisted indexes are rebuilt
+EMBEDDING_VERSION = 1
+# Width of the hashed embedding vectors
+EMBEDDING_DIM = int(os.environ.get("DATALIS_EMBEDDING_DIM", 1024))
+# Document tokens per retrievable chunk
+RETRIEVAL_CHUNK_TOKENS = int(os.environ.get("DATALIS_RETRIEVAL_CHUNK_TOKENS", 400))
+# Chunks added to each chat prompt
+RETRIEVAL_TOP_K = int(os.environ.get("DATALIS_RETRIEVAL_TOP_K", 4))
+# Chunks scoring below this cosine similarity are never added
+RETRIEVAL_MIN_SCORE = float(os.environ.get("DATALIS_RETRIEVAL_MIN_SCORE", 0.1))
+# Where document indexes are persisted by content hash ("" disables persistence)
+VECTOR_INDEX_DIR = os.environ.get(
+    "DATALIS_VECTOR_INDEX_DIR", os.path.join(tempfile.gettempdir(), "datalis_vector_index")
+)
+# Document indexes kept in memory
+VECTOR_INDEX_MAX_MB = int(os.environ.get("DATALIS_VECTOR_INDEX_MAX_MB", 256))
+# How long a search waits for documents of the session that are still being indexed
+INDEX_WAIT_SECONDS = 10
+
+# Words, numbers and identifiers such as 27AAACB1234Q1Z5, 194J or 2024-25
+WORD_PATTERN = re.compile(r"[a-z0-9]+(?:[./-][a-z0-9]+)*")
+
+
+def embed_texts(texts, dim=EMBEDDING_DIM):
+    """Embed texts as L2-normalised hashed bag-of-words vectors.
+
+    Words and word pairs are hashed into dim buckets with a signed hash
+    (CRC32, so vectors are stable across processes and can be persisted)
+    and weighted by log term frequency. Cosine similarity is then a plain
+    dot product.
+    """
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        words = WORD_PATTERN.findall(text.lower())
+        features = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+        if not features:
+            continue
+        hashes = np.fromiter(
+            (zlib.crc32(feature.encode('utf-8')) for feature in features), dtype=np.uint32, count=len(features)
+        )
+        # The low bits pick the bucket and the top bit the sign
+        signs = np.where(hashes >> 31, -1.0, 1.0)
+        matrix[row] = np.bincount(hashes % dim, weights=signs, minlength=dim)
+    matrix = np.sign(matrix) * np.log1p(np.abs(matrix))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class VectorIndex:
+    """Per-session retrieval over uploaded documents.
+
+    Each document is chunked and embedded once per content hash, in a
+    background thread as soon as it is uploaded, and the result is kept in
+    an in-memory LRU and persisted to disk so re-uploads are free. Sessions
+    only hold the keys of the documents they uploaded, so the LRU alone
+    bounds memory; a search re-fetches each document (from disk after an
+    eviction) and scores its chunks with one matrix-vector product.
+    """
+
+    def __init__(self, directory=VECTOR_INDEX_DIR, chunk_tokens=RETRIEVAL_CHUNK_TOKENS, dim=EMBEDDING_DIM,
+                 max_bytes=VECTOR_INDEX_MAX_MB * 1024 * 1024):
+        self.directory = directory or None
+        self.chunk_tokens = chunk_tokens
+        self.dim = dim
+        self._documents = LRUCache(
+            max_entries=None,
+            max_bytes=max_bytes,
+            size_of=lambda document: document[1].nbytes + sum(len(chunk) for chunk in document[0])
+        )
+        # session id -> list of (file name, document key, load_text, future resolving to whether it is indexed)
+        self._sessions = SessionStore()
+        self._lock = threading.Lock()
+        self._executor = None
+        self.builds = 0
+        self.disk_loads = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="datalis-index")
+            return self._executor
+
+    def document_key(self, content_key):
+        """Key of a document's index, from its extraction cache key."""
+        return f"{content_key}:emb{EMBEDDING_VERSION}:{self.dim}:{self.chunk_tokens}"
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f"{name}.npz")
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with np.load(self._path(key), allow_pickle=False) as data:
+                if str(data["key"]) != key:
+                    return None
+                document = (json.loads(str(data["chunks"])), data["vectors"])
+        except (OSError, ValueError, KeyError):
+            return None
+        with self._lock:
+            self.disk_loads += 1
+        return document
+
+    def _save(self, key, document):
+        if self.directory is None:
+            return
+        chunks, vectors = document
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                np.savez(file, key=np.array(key), chunks=np.array(json.dumps(chunks)), vectors=vectors)
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            print(f"Error saving vector index: {str(e)}")
+
+    def _get_document(self, key, load_text):
+        """Return (chunks, vectors) for a document, building them if needed."""
+        try:
+            return self._load_or_build(key, load_text)
+        except Exception as e:
+            print(f"Error indexing document: {str(e)}")
+            return None
+
+    def _load_or_build(self, key, load_text):
+        document = self._documents.get(key)
+        if document is not None:
+            return document
+        document = self._load(key)
+        if document is None:
+            text = load_text()
+            if text is None:
+                return None
+            chunks = list(iter_token_chunks(text, self.chunk_tokens))
+            document = (chunks, embed_texts(chunks, self.dim))
+            with self._lock:
+                self.builds += 1
+            self._save(key, document)
+        self._documents.set(key, document)
+        return document
+
+    def _index_document(self, key, load_text):
+        # The future only reports success, so it does not keep the document alive
+        return self._get_document(key, load_text) is not None
+
+    def add_document(self, session_id, file_name, content_key, load_text):
+        """Index a document for a session in the background.
+
+        content_key identifies the document's content (e.g.
+        FileHandler.extraction_cache_key) and load_text() returns its text,
+        or None if it cannot be indexed; it is only called on a cache miss.
+        Returns a future resolving to whether the document was indexed.
+        """
+        key = self.document_key(content_key)
+        future = self._get_executor().submit(self._index_document, key, load_text)
+        documents = self._sessions.setdefault(session_id, [])
+        documents.append((file_name, key, load_text, future))
+        return future
+
+    def drop_session(self, session_id):
+        """Forget which documents a session uploaded (the document indexes stay cached)."""
+        self._sessions.pop(session_id, None)
+
+    def search(self, session_id, query, k=RETRIEVAL_TOP_K, min_score=RETRIEVAL_MIN_SCORE):
+        """Return the session's k chunks most similar to the query, best first,
+        as dicts with file, chunk (index), text and score."""
+        documents = self._sessions.get(session_id)
+        if not documents or not query.strip():
+            return []
+
+        # Documents uploaded a moment ago may still be indexing
+        wait([future for _, _, _, future in documents], timeout=INDEX_WAIT_SECONDS)
+
+        query_vector = embed_texts([query], self.dim)[0]
+        candidates = []
+        for file_name, key, load_text, future in documents:
+            if not future.done() or not future.result():
+                continue
+            # Evicted documents are reloaded from disk (or rebuilt without persistence)
+            document = self._get_document(key, load_text)
+            if document is None or not document[0]:
+                continue
+            chunks, vectors = document
+            scores = vectors @ query_vector
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+            for index in top:
+                if scores[index] >= min_score:
+                    candidates.append({
+                        "file": file_name,
+                        "chunk": int(index),
+                        "text": chunks[index],
+                        "score": float(scores[index]),
+                    })
+        candidates.sort(key=lambda candidate: candidate["score"], reverse=True)
+        return candidates[:k]
+
+    def stats(self):
+        """Return index counters for monitoring."""
+        with self._lock:
+            builds, disk_loads = self.builds, self.disk_loads
+        return {
+            "sessions": len(self._sessions),
+            "builds": builds,
+            "disk_loads": disk_loads,
+            "memory": self._documents.stats(),
+        }
+
+
+# Shared by every agent and session; document indexes are shared across sessions
+VECTOR_INDEX = VectorIndex()
+tracing.register_stats("vector_index", VECTOR_INDEX.stats)